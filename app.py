@@ -1,14 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, g, has_request_context, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import os
-import requests
-import uuid
-from sqlalchemy import or_, func, text
+import secrets
+import hashlib
+import re
+import difflib
+import json
+import queue
+import atexit
+import multiprocessing
+import click
+import threading
+import time
+import itertools
+from sqlalchemy import or_, and_, func, text, select, lambda_stmt, event, delete, update, insert, bindparam, false
+from sqlalchemy.exc import OperationalError, DBAPIError
 from dotenv import load_dotenv
 from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import selectinload, validates
 from urllib.parse import urlparse
+from collections import OrderedDict
+from system_limits import available_cpus
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -20,6 +38,28 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'ваш-очень-дл
 # Настройки сессии
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 app.config['SESSION_REFRESH_EACH_REQUEST'] = True
+# database - сессии хранятся в таблице user_session, в cookie только короткий id;
+# cookie - стандартные подписанные cookie Flask
+app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'database').lower()
+# Как часто (в секундах) фоновый поток удаляет истекшие сессии
+app.config['SESSION_CLEANUP_INTERVAL'] = int(os.environ.get('SESSION_CLEANUP_INTERVAL', 600))
+
+# Журнал изменений: как часто (в секундах) сбрасывать буфер в БД и сколько записей держать в памяти
+app.config['AUDIT_FLUSH_INTERVAL'] = int(os.environ.get('AUDIT_FLUSH_INTERVAL', 5))
+app.config['AUDIT_BUFFER_SIZE'] = int(os.environ.get('AUDIT_BUFFER_SIZE', 10000))
+# Пауза перед новой попыткой записать журнал после ошибки базы, сек
+app.config['AUDIT_RETRY_INTERVAL'] = int(os.environ.get('AUDIT_RETRY_INTERVAL', 30))
+
+# Удаленные контрагенты хранятся SOFT_DELETE_RETENTION_DAYS дней (можно восстановить),
+# затем фоновая задача удаляет их окончательно раз в PURGE_INTERVAL секунд
+app.config['SOFT_DELETE_RETENTION_DAYS'] = int(os.environ.get('SOFT_DELETE_RETENTION_DAYS', 30))
+app.config['PURGE_INTERVAL'] = int(os.environ.get('PURGE_INTERVAL', 3600))
+
+# Как часто (в секундах) удаляются истекшие токены восстановления пароля
+app.config['RESET_TOKEN_CLEANUP_INTERVAL'] = int(os.environ.get('RESET_TOKEN_CLEANUP_INTERVAL', 3600))
+
+# Сколько контрагентов показывать на одной странице списка и поиска
+app.config['CONTRAGENTS_PAGE_SIZE'] = int(os.environ.get('CONTRAGENTS_PAGE_SIZE', 50))
 
 # ========== НАСТРОЙКА БАЗЫ ДАННЫХ (ТОЛЬКО POSTGRESQL) ==========
 database_url = os.environ.get('DATABASE_URL')
@@ -32,10 +72,14 @@ if not database_url:
     exit(1)
 
 # Преобразование URL для PostgreSQL (если требуется)
-if database_url.startswith('postgres://'):
-    database_url = database_url.replace('postgres://', 'postgresql+psycopg://', 1)
-elif database_url.startswith('postgresql://'):
-    database_url = database_url.replace('postgresql://', 'postgresql+psycopg://', 1)
+def normalize_database_url(url):
+    if url.startswith('postgres://'):
+        return url.replace('postgres://', 'postgresql+psycopg://', 1)
+    if url.startswith('postgresql://'):
+        return url.replace('postgresql://', 'postgresql+psycopg://', 1)
+    return url
+
+database_url = normalize_database_url(database_url)
 
 print(f"📦 Подключаемся к базе данных PostgreSQL...")
 
@@ -47,27 +91,155 @@ is_local_dev = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
 engine_options = {
     'pool_recycle': 300,
     'pool_pre_ping': True,
-    'poolclass': NullPool,
 }
+connect_args = {}
+
+# DB_POOL_SIZE > 0 включает постоянный пул соединений вместо NullPool
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', 0))
+
+if db_pool_size > 0:
+    engine_options['pool_size'] = db_pool_size
+    engine_options['max_overflow'] = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    engine_options['pool_timeout'] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    # Соединения живут долго - горячие запросы имеет смысл подготавливать на сервере
+    connect_args['prepare_threshold'] = int(os.environ.get('DB_PREPARE_THRESHOLD', 2))
+    print(f"✅ Постоянный пул соединений: {db_pool_size} (+{engine_options['max_overflow']})")
+else:
+    engine_options['poolclass'] = NullPool
+    # Соединение закрывается после запроса - подготовленные выражения бесполезны
+    connect_args['prepare_threshold'] = None
+
+# Недоступная база не должна подвешивать запрос (и /readyz) надолго
+connect_args['connect_timeout'] = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
 
 if is_render and not is_local_dev:
     # На Render с PostgreSQL - требуется SSL
-    engine_options['connect_args'] = {"sslmode": "require"}
+    connect_args['sslmode'] = 'require'
     print(f"✅ Настроено SSL подключение для Render")
 else:
     # Локально - без SSL
     print(f"✅ Локальная разработка - SSL не требуется")
 
+if database_url.startswith('postgresql+psycopg://'):
+    engine_options['connect_args'] = connect_args
+
 # Настраиваем приложение
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# ========== РЕПЛИКИ ДЛЯ ЧТЕНИЯ (НЕОБЯЗАТЕЛЬНО) ==========
+# DATABASE_REPLICA_URLS - список URL реплик через запятую. Маршруты с декоратором
+# @replica_read читают с реплик, все остальное по-прежнему идет в основную базу.
+replica_urls = [normalize_database_url(url.strip())
+                for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# round_robin или least_connections
+replica_balancing = os.environ.get('DATABASE_REPLICA_BALANCING', 'round_robin').lower()
+# Сколько секунд после записи пользователь читает только из основной базы
+replica_sticky_seconds = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 5))
+# На сколько секунд исключаем упавшую реплику из балансировки
+replica_retry_seconds = int(os.environ.get('DATABASE_REPLICA_RETRY_SECONDS', 30))
+
+replica_keys = [f'replica_{i}' for i in range(len(replica_urls))]
+replica_in_use = {key: 0 for key in replica_keys}
+replica_down_until = {key: 0.0 for key in replica_keys}
+replica_counter = itertools.count()
+replica_lock = threading.Lock()
+
+app.config['SQLALCHEMY_BINDS'] = {
+    key: {'url': url, **engine_options} for key, url in zip(replica_keys, replica_urls)
+}
+
+if replica_keys:
+    print(f"✅ Реплики для чтения: {len(replica_keys)} ({replica_balancing})")
+
+def choose_replica():
+    """
+    Возвращает ключ здоровой реплики или None, если читать нужно из основной базы
+    """
+    now = time.monotonic()
+    with replica_lock:
+        healthy = [key for key in replica_keys if replica_down_until[key] <= now]
+        if not healthy:
+            return None
+        if replica_balancing == 'least_connections':
+            return min(healthy, key=lambda key: replica_in_use[key])
+        return healthy[next(replica_counter) % len(healthy)]
+
+class RoutingSession(FlaskSQLAlchemySession):
+    """
+    Сессия, которая отправляет чтение на реплику, если маршрут это разрешил.
+    Запись (flush) всегда идет в основную базу.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('db_use_replica'):
+            if 'db_replica_key' not in g:
+                g.db_replica_key = choose_replica()
+            if g.db_replica_key is not None:
+                return self._db.engines[g.db_replica_key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 # Инициализируем db
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+def track_replica_connections(key):
+    engine = db.engines[key]
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with replica_lock:
+            replica_in_use[key] += 1
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        with replica_lock:
+            replica_in_use[key] -= 1
+
+    @event.listens_for(engine, 'handle_error')
+    def on_error(context):
+        # Запоминаем, что ошибка произошла именно на реплике, а не на основной базе
+        if has_request_context():
+            g.db_replica_failed = key
+
+with app.app_context():
+    for key in replica_keys:
+        track_replica_connections(key)
+
+def register_sqlite_functions(engine):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # Встроенный lower() в SQLite не понимает кириллицу, а поиск выполняется в SQL -
+        # при локальном запуске ведем себя так же, как PostgreSQL
+        dbapi_connection.create_function(
+            'lower', 1, lambda value: value.lower() if isinstance(value, str) else value, deterministic=True
+        )
+
+with app.app_context():
+    for engine in db.engines.values():
+        if engine.dialect.name == 'sqlite':
+            register_sqlite_functions(engine)
+
+def remember_write_time():
+    # Запоминаем время записи в сессии пользователя, чтобы его следующие
+    # чтения шли в основную базу, пока реплика не догонит
+    if replica_keys and has_request_context():
+        session['db_write_at'] = time.time()
+
+@event.listens_for(RoutingSession, 'after_flush')
+def remember_flush_time(db_session, flush_context):
+    remember_write_time()
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def remember_bulk_write_time(orm_execute_state):
+    # UPDATE/DELETE через session.execute не проходят через flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        remember_write_time()
 
 # ========== ФУНКЦИЯ ОТПРАВКИ ПИСЬМА ЧЕРЕЗ UNISENDER API ==========
 def send_reset_email_via_unisender(email, reset_url):
+    # requests импортируется только при отправке письма - это ускоряет запуск воркера
+    import requests
+    
     api_key = os.environ.get('UNISENDER_API_KEY')
     sender_email = os.environ.get('MAIL_DEFAULT_SENDER')
     
@@ -156,6 +328,8 @@ def get_translations(lang='ru'):
             'create_copy': 'Создать копию',
             'delete': 'Удалить',
             'no_contragents': 'Контрагентов не найдено',
+            'next_page': 'Следующая страница →',
+            'first_page': '← В начало',
             'change_search': 'Измените параметры поиска или добавьте контрагента',
             'welcome_to_system': 'Добро пожаловать в систему "Контрагенты"!',
             'need_auth': 'Для работы с контрагентами необходимо',
@@ -248,7 +422,22 @@ def get_translations(lang='ru'):
             'copy_not_found': 'Контрагент для копирования не найден',
             'invalid_copy_id': 'Некорректный ID для копирования',
             'org_name_required': 'Название организации обязательно для заполнения',
-            'error_adding': 'Ошибка при добавлении контрагента'
+            'error_adding': 'Ошибка при добавлении контрагента',
+            'duplicate_found': 'Похоже, такой контрагент уже есть (совпадает ИНН или наименование):',
+            'add_anyway': 'Все равно добавить',
+            'undo': 'Отменить',
+            'restore_success': 'Контрагент восстановлен',
+            'restore_expired': 'Контрагент не найден или срок восстановления истек',
+            'team_name_required': 'Название команды обязательно',
+            'team_created': 'Команда создана',
+            'team_access_denied': 'Недостаточно прав в команде',
+            'team_invalid_role': 'Некорректная роль',
+            'team_member_saved': 'Участник сохранен',
+            'team_member_removed': 'Участник исключен',
+            'team_shared': 'Доступ к контрагенту изменен',
+            'book': 'Книга',
+            'personal_book': 'Личная книга',
+            'user_not_found': 'Пользователь не найден'
         },
         'en': {
             'title': 'Counterparties',
@@ -285,6 +474,8 @@ def get_translations(lang='ru'):
             'create_copy': 'Create copy',
             'delete': 'Delete',
             'no_contragents': 'No counterparties found',
+            'next_page': 'Next page →',
+            'first_page': '← Back to start',
             'change_search': 'Change search parameters or add counterparty',
             'welcome_to_system': 'Welcome to "Counterparties" system!',
             'need_auth': 'To work with counterparties you need to',
@@ -377,7 +568,22 @@ def get_translations(lang='ru'):
             'copy_not_found': 'Counterparty for copying not found',
             'invalid_copy_id': 'Invalid copy ID',
             'org_name_required': 'Organization name is required',
-            'error_adding': 'Error adding counterparty'
+            'error_adding': 'Error adding counterparty',
+            'duplicate_found': 'This counterparty seems to exist already (same Tax ID or name):',
+            'add_anyway': 'Add anyway',
+            'undo': 'Undo',
+            'restore_success': 'Counterparty restored',
+            'restore_expired': 'Counterparty not found or the restore period has expired',
+            'team_name_required': 'Team name is required',
+            'team_created': 'Team created',
+            'team_access_denied': 'Insufficient team permissions',
+            'team_invalid_role': 'Invalid role',
+            'team_member_saved': 'Member saved',
+            'team_member_removed': 'Member removed',
+            'team_shared': 'Counterparty access updated',
+            'book': 'Book',
+            'personal_book': 'Personal book',
+            'user_not_found': 'User not found'
         }
     }
     return translations.get(lang, translations['ru'])
@@ -391,8 +597,6 @@ class User(db.Model):
     password_hash = db.Column(db.String(200), nullable=False)
     email = db.Column(db.String(120))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    reset_token = db.Column(db.String(100), nullable=True)
-    reset_token_expires = db.Column(db.DateTime, nullable=True)
     
     contragents = db.relationship('Contragent', backref='owner', lazy=True, cascade="all, delete-orphan")
     
@@ -402,24 +606,120 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+# Модель токена восстановления пароля (в БД хранится только SHA-256 токена)
+class PasswordResetToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+def hash_reset_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+# Модель команды с общей книгой контрагентов
+class Team(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Роли участников команды: read - только просмотр, write - изменение, owner - еще и управление участниками
+TEAM_ROLES = ('read', 'write', 'owner')
+TEAM_WRITE_ROLES = ('write', 'owner')
+
+# Модель участия пользователя в команде
+class TeamMember(db.Model):
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True, index=True)
+    role = db.Column(db.String(10), nullable=False, default='read')
+
+# Модель серверной сессии
+class UserSession(db.Model):
+    id = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+def normalize_phone(number):
+    """
+    Телефон в формате E.164 без '+': только цифры с кодом страны.
+    Российские номера без кода страны (10 цифр, '(495) 123-45-67', '900 ...')
+    и через 8 ('8 495 ...') приводятся к '7...'. Номер с '+' уже содержит код
+    страны: '+81 3 1234 5678' остается '81312345678'
+    """
+    digits = re.sub(r'\D', '', number or '')
+    if (number or '').lstrip().startswith('+'):
+        return digits[:20] or None
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+    return digits[:20] or None
+
+def normalize_email(address):
+    return (address or '').strip().lower()[:120] or None
+
 # Модель телефона
 class Phone(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    contragent_id = db.Column(db.Integer, db.ForeignKey('contragent.id'), nullable=False)
+    contragent_id = db.Column(db.Integer, db.ForeignKey('contragent.id'), nullable=False, index=True)
     number = db.Column(db.String(50), nullable=False)
+    # Нормализованный номер для точного и префиксного поиска по индексу
+    number_normalized = db.Column(db.String(20))
+    
+    __table_args__ = (
+        db.Index('ix_phone_number_normalized', 'number_normalized',
+                 postgresql_ops={'number_normalized': 'varchar_pattern_ops'}),
+    )
+    
+    @validates('number')
+    def validate_number(self, key, value):
+        self.number_normalized = normalize_phone(value)
+        return value
 
 # Модель email
 class Email(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    contragent_id = db.Column(db.Integer, db.ForeignKey('contragent.id'), nullable=False)
+    contragent_id = db.Column(db.Integer, db.ForeignKey('contragent.id'), nullable=False, index=True)
     address = db.Column(db.String(120), nullable=False)
+    # Адрес в нижнем регистре для точного и префиксного поиска по индексу
+    address_normalized = db.Column(db.String(120))
+    
+    __table_args__ = (
+        db.Index('ix_email_address_normalized', 'address_normalized',
+                 postgresql_ops={'address_normalized': 'varchar_pattern_ops'}),
+    )
+    
+    @validates('address')
+    def validate_address(self, key, value):
+        self.address_normalized = normalize_email(value)
+        return value
 
 # Модель сайта
 class Website(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    contragent_id = db.Column(db.Integer, db.ForeignKey('contragent.id'), nullable=False)
+    contragent_id = db.Column(db.Integer, db.ForeignKey('contragent.id'), nullable=False, index=True)
     url = db.Column(db.String(200), nullable=False)
 
+# Организационно-правовые формы, которые не учитываются при поиске дубликатов
+LEGAL_FORMS_RE = re.compile(r'\b(ооо|оао|зао|пао|ао|ип|нко|ано|гуп|муп|фгуп|llc|ltd|inc|gmbh|corp)\b')
+
+def normalize_inn(inn):
+    """
+    ИНН без пробелов и прочих символов - только цифры
+    """
+    digits = re.sub(r'\D', '', inn or '')
+    return digits[:20] or None
+
+def normalize_org_name(org_name):
+    """
+    Наименование в нижнем регистре без кавычек, знаков препинания и ОПФ:
+    'ООО "Ромашка"' и 'Ромашка ООО' дают одно и то же значение
+    """
+    name = (org_name or '').lower().replace('ё', 'е')
+    name = re.sub(r'[^\w\s]', ' ', name)
+    name = LEGAL_FORMS_RE.sub(' ', name)
+    return ' '.join(name.split())[:200] or None
+
 # Модель контрагента
 class Contragent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -430,10 +730,1383 @@ class Contragent(db.Model):
     address = db.Column(db.String(300))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Команда, в общей книге которой лежит контрагент; NULL - личная книга user_id
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'))
+    # Нормализованные значения для быстрого поиска дубликатов
+    inn_normalized = db.Column(db.String(20))
+    org_name_normalized = db.Column(db.String(200))
+    # Время удаления; NULL - активная запись
+    deleted_at = db.Column(db.DateTime)
     
     phones = db.relationship('Phone', backref='contragent', lazy=True, cascade="all, delete-orphan")
     emails = db.relationship('Email', backref='contragent', lazy=True, cascade="all, delete-orphan")
     websites = db.relationship('Website', backref='contragent', lazy=True, cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        db.Index('ix_contragent_user_inn', 'user_id', 'inn_normalized'),
+        db.Index('ix_contragent_user_org_name', 'user_id', 'org_name_normalized'),
+        db.Index('ix_contragent_team_inn', 'team_id', 'inn_normalized'),
+        db.Index('ix_contragent_team_org_name', 'team_id', 'org_name_normalized'),
+    )
+    
+    @validates('inn')
+    def validate_inn(self, key, value):
+        self.inn_normalized = normalize_inn(value)
+        return value
+    
+    @validates('org_name')
+    def validate_org_name(self, key, value):
+        self.org_name_normalized = normalize_org_name(value)
+        return value
+
+# Модель записи журнала изменений (только добавление)
+class AuditLog(db.Model):
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    contragent_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    changes = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_audit_log_user_id', 'user_id', 'id'),
+        db.Index('ix_audit_log_contragent_id', 'contragent_id', 'id'),
+    )
+
+# Модель фоновой задачи (импорт, экспорт, переиндексация, поиск дубликатов)
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = db.Column(db.String(30), nullable=False)
+    # queued -> running -> done | failed | cancelled
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    params = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_job_status', 'status', 'id'),
+    )
+
+# Часть результата задания (экспорт): одна порция записей в виде JSON-массива
+class JobResultChunk(db.Model):
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id', ondelete='CASCADE'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.Text, nullable=False)
+
+# Модель примененной миграции схемы
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# ========== ГОРЯЧИЕ ЗАПРОСЫ ==========
+# Запросы, которые выполняются почти на каждом запросе, построены через lambda_stmt:
+# SQLAlchemy кэширует их конструкцию и компиляцию SQL, а значения из замыкания
+# передаются как связанные параметры.
+
+def get_user_by_id(user_id):
+    return db.session.get(User, user_id)
+
+def get_user_by_username(username):
+    stmt = lambda_stmt(lambda: select(User).where(User.username == username))
+    return db.session.execute(stmt).scalars().first()
+
+def get_user_by_email(email):
+    stmt = lambda_stmt(lambda: select(User).where(User.email == email))
+    return db.session.execute(stmt).scalars().first()
+
+def contragent_by_id_stmt(contragent_id, user_id, team_ids):
+    """
+    Контрагент из личной книги пользователя или из книги одной из команд team_ids
+    """
+    return lambda_stmt(lambda: select(Contragent).where(
+        Contragent.id == contragent_id,
+        or_(and_(Contragent.team_id.is_(None), Contragent.user_id == user_id),
+            Contragent.team_id.in_(team_ids)),
+        Contragent.deleted_at.is_(None)
+    ))
+
+def get_user_by_reset_token(token):
+    """
+    Пользователь по действующему токену восстановления - поиск по уникальному индексу хэша
+    """
+    token_hash = hash_reset_token(token)
+    now = datetime.utcnow()
+    stmt = lambda_stmt(lambda: select(User).join(PasswordResetToken).where(
+        PasswordResetToken.token_hash == token_hash,
+        PasswordResetToken.expires_at > now
+    ))
+    return db.session.execute(stmt).scalars().first()
+
+def get_contragent_for_user(contragent_id, user_id, team_ids):
+    return db.session.execute(contragent_by_id_stmt(contragent_id, user_id, team_ids)).scalars().first()
+
+def get_contragents_for_user(user_id, team_ids, before_id=None, limit=None):
+    """
+    Контрагенты пользователя и его команд (новые первыми) вместе с телефонами, email и сайтами.
+    before_id и limit - keyset-пагинация по id: страница читается по индексу
+    (user_id, id DESC) / (team_id, id DESC), без OFFSET и без загрузки всей книги.
+    Дочерние записи подгружаются тремя запросами selectin вместо N ленивых загрузок в шаблоне.
+    """
+    stmt = lambda_stmt(lambda: select(Contragent).where(
+        or_(and_(Contragent.team_id.is_(None), Contragent.user_id == user_id),
+            Contragent.team_id.in_(team_ids)),
+        Contragent.deleted_at.is_(None)
+    ))
+    if before_id is not None:
+        stmt += lambda s: s.where(Contragent.id < before_id)
+    stmt += lambda s: s.options(
+        selectinload(Contragent.phones),
+        selectinload(Contragent.emails),
+        selectinload(Contragent.websites)
+    )
+    stmt += lambda s: s.order_by(Contragent.id.desc())
+    if limit is not None:
+        stmt += lambda s: s.limit(limit)
+    return db.session.execute(stmt).scalars().all()
+
+def count_contragents_for_user(user_id, team_ids):
+    """Сколько всего контрагентов в книгах пользователя (для личного кабинета)"""
+    stmt = lambda_stmt(lambda: select(func.count()).select_from(Contragent).where(
+        or_(and_(Contragent.team_id.is_(None), Contragent.user_id == user_id),
+            Contragent.team_id.in_(team_ids)),
+        Contragent.deleted_at.is_(None)
+    ))
+    return db.session.execute(stmt).scalar()
+
+# ========== ФОНОВЫЕ ЗАДАЧИ ==========
+
+# Ключ advisory-блокировки процесса, который выполняет общие чистки
+SWEEPER_LOCK_ID = 7425002
+# Выделенное соединение, держащее блокировку (только в процессе-лидере)
+sweeper_connection = None
+sweeper_lock = threading.Lock()
+
+def is_sweeper_leader():
+    """
+    Общие чистки (сессии, токены, удаленные записи) должны выполняться один раз
+    на все развертывание, а не в каждом воркере gunicorn. Лидер - процесс, который
+    держит сессионную advisory-блокировку на своем соединении; если он умирает,
+    соединение закрывается и блокировку на следующем тике забирает другой воркер.
+    """
+    global sweeper_connection
+    if db.engine.dialect.name != 'postgresql':
+        return True
+    with sweeper_lock:
+        if sweeper_connection is not None:
+            try:
+                sweeper_connection.execute(text("SELECT 1"))
+                sweeper_connection.commit()
+                return True
+            except Exception:
+                sweeper_connection.invalidate()
+                sweeper_connection.close()
+                sweeper_connection = None
+        conn = db.engine.connect()
+        try:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:lock_id)"),
+                                    {'lock_id': SWEEPER_LOCK_ID}).scalar()
+            # Блокировка сессионная - транзакцию закрываем, чтобы не висеть в idle in transaction
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        if not acquired:
+            conn.close()
+            return False
+        sweeper_connection = conn
+        print(f"ℹ️  Процесс {os.getpid()} выполняет общие фоновые чистки")
+        return True
+
+def start_periodic_task(name, interval, func, singleton=False):
+    """
+    Запускает func каждые interval секунд в фоновом потоке текущего процесса.
+    singleton=True - выполнять только в процессе-лидере (см. is_sweeper_leader).
+    Ошибки логируются и не останавливают поток.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    if singleton and not is_sweeper_leader():
+                        continue
+                    func()
+            except Exception as e:
+                print(f"⚠️  Ошибка фоновой задачи {name}: {e}")
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def delete_in_batches(table, condition, batch_size=1000):
+    """
+    Удаляет строки порциями по batch_size, чтобы не держать долгих блокировок.
+    Возвращает общее число удаленных строк.
+    """
+    total = 0
+    while True:
+        batch = select(table.c.id).where(condition).limit(batch_size).scalar_subquery()
+        with db.engine.begin() as conn:
+            deleted = conn.execute(delete(table).where(table.c.id.in_(batch))).rowcount
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+def purge_deleted_contragents(batch_size=500):
+    """
+    Окончательно удаляет контрагентов, удаленных раньше срока хранения.
+    Каждая порция - несколько DELETE ... WHERE contragent_id IN (...) без загрузки объектов.
+    """
+    contragents = Contragent.__table__
+    cutoff = datetime.utcnow() - timedelta(days=app.config['SOFT_DELETE_RETENTION_DAYS'])
+    total = 0
+    while True:
+        with db.engine.begin() as conn:
+            ids = conn.execute(
+                select(contragents.c.id)
+                .where(contragents.c.deleted_at < cutoff)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            if ids:
+                for child in (Phone.__table__, Email.__table__, Website.__table__):
+                    conn.execute(delete(child).where(child.c.contragent_id.in_(ids)))
+                conn.execute(delete(contragents).where(contragents.c.id.in_(ids)))
+        total += len(ids)
+        if len(ids) < batch_size:
+            break
+    if total:
+        print(f"🧹 Окончательно удалено контрагентов: {total}")
+    return total
+
+# ========== МИГРАЦИИ СХЕМЫ ==========
+# create_all создает только отсутствующие таблицы. Новые колонки и индексы
+# в существующих таблицах добавляются миграциями ниже (только PostgreSQL).
+# Каждая версия - список SQL-строк или функций, принимающих соединение.
+# Функции, заполняющие колонки, фиксируют работу порциями (conn.commit()),
+# чтобы не держать одну огромную транзакцию; DDL написан с IF NOT EXISTS,
+# поэтому прерванную на середине версию можно безопасно применить повторно.
+
+def backfill_contragent_normalized(conn, batch_size=1000):
+    table = Contragent.__table__
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c.inn, table.c.org_name)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        conn.execute(
+            update(table).where(table.c.id == bindparam('row_id')),
+            [{'row_id': row.id,
+              'inn_normalized': normalize_inn(row.inn),
+              'org_name_normalized': normalize_org_name(row.org_name)} for row in rows]
+        )
+        conn.commit()
+        last_id = rows[-1].id
+
+# Нормализованные колонки телефонов и email: (таблица, исходная колонка, колонка, функция)
+CONTACT_NORMALIZED_COLUMNS = [
+    (Phone.__table__, 'number', 'number_normalized', normalize_phone),
+    (Email.__table__, 'address', 'address_normalized', normalize_email),
+]
+
+def backfill_column_batch(conn, table, column, normalized_column, normalize, after_id, batch_size=1000,
+                          condition=None):
+    """
+    Заполняет нормализованную колонку у следующей порции строк с id > after_id
+    (и подходящих под condition, если оно задано).
+    Возвращает число обработанных строк и id последней из них.
+    """
+    stmt = select(table.c.id, table.c[column]).where(table.c.id > after_id)
+    if condition is not None:
+        stmt = stmt.where(condition)
+    rows = conn.execute(stmt.order_by(table.c.id).limit(batch_size)).all()
+    if not rows:
+        return 0, after_id
+    conn.execute(
+        update(table).where(table.c.id == bindparam('row_id')),
+        [{'row_id': row.id, normalized_column: normalize(row[1])} for row in rows]
+    )
+    return len(rows), rows[-1].id
+
+def backfill_contacts_normalized(conn, columns=CONTACT_NORMALIZED_COLUMNS, batch_size=1000, condition=None):
+    """
+    Пересчитывает нормализованные колонки порциями, фиксируя каждую.
+    Возвращает число обработанных строк по таблицам.
+    """
+    totals = {}
+    for table, column, normalized_column, normalize in columns:
+        total = 0
+        last_id = 0
+        while True:
+            count, last_id = backfill_column_batch(conn, table, column, normalized_column,
+                                                   normalize, last_id, batch_size, condition)
+            conn.commit()
+            if not count:
+                break
+            total += count
+        totals[table.name] = total
+    return totals
+
+def backfill_phones_normalized(conn):
+    # Номера без кода страны раньше сохранялись без ведущей 7
+    backfill_contacts_normalized(conn, CONTACT_NORMALIZED_COLUMNS[:1])
+
+def backfill_international_phones(conn):
+    # Миграция 7 добавляла 7 и к международным номерам с '+' - пересчитываем только их
+    number = func.ltrim(Phone.__table__.c.number)
+    backfill_contacts_normalized(conn, CONTACT_NORMALIZED_COLUMNS[:1],
+                                 condition=and_(number.like('+%'), ~number.like('+7%')))
+
+SCHEMA_MIGRATIONS = [
+    (1, [
+        "ALTER TABLE contragent ADD COLUMN IF NOT EXISTS inn_normalized VARCHAR(20)",
+        "ALTER TABLE contragent ADD COLUMN IF NOT EXISTS org_name_normalized VARCHAR(200)",
+        backfill_contragent_normalized,
+        "CREATE INDEX IF NOT EXISTS ix_contragent_user_inn ON contragent (user_id, inn_normalized)",
+        "CREATE INDEX IF NOT EXISTS ix_contragent_user_org_name ON contragent (user_id, org_name_normalized)",
+    ]),
+    (2, [
+        # Внешние ключи дочерних таблиц - для selectin-загрузки и join при поиске
+        "CREATE INDEX IF NOT EXISTS ix_phone_contragent_id ON phone (contragent_id)",
+        "CREATE INDEX IF NOT EXISTS ix_email_contragent_id ON email (contragent_id)",
+        "CREATE INDEX IF NOT EXISTS ix_website_contragent_id ON website (contragent_id)",
+        # Префиксный поиск для подсказок: lower(col) LIKE 'abc%'
+        "CREATE INDEX IF NOT EXISTS ix_contragent_user_org_name_prefix ON contragent (user_id, lower(org_name) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_contragent_user_inn_prefix ON contragent (user_id, lower(inn) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_contragent_user_contact_prefix ON contragent (user_id, lower(contact_person) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_phone_number_prefix ON phone (lower(number) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_email_address_prefix ON email (lower(address) text_pattern_ops)",
+    ]),
+    (3, [
+        "ALTER TABLE contragent ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+        # Частичные индексы: список активных записей и поиск записей для окончательного удаления
+        "CREATE INDEX IF NOT EXISTS ix_contragent_user_active ON contragent (user_id, id DESC) WHERE deleted_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_contragent_deleted_at ON contragent (deleted_at) WHERE deleted_at IS NOT NULL",
+    ]),
+    (4, [
+        "ALTER TABLE contragent ADD COLUMN IF NOT EXISTS team_id INTEGER REFERENCES team (id)",
+        # Общая книга команды - тот же частичный индекс, что и для личной
+        "CREATE INDEX IF NOT EXISTS ix_contragent_team_active ON contragent (team_id, id DESC) WHERE deleted_at IS NULL",
+    ]),
+    (5, [
+        "ALTER TABLE phone ADD COLUMN IF NOT EXISTS number_normalized VARCHAR(20)",
+        "ALTER TABLE email ADD COLUMN IF NOT EXISTS address_normalized VARCHAR(120)",
+        backfill_contacts_normalized,
+        # varchar_pattern_ops - чтобы B-tree работал и для LIKE 'abc%' при любой локали
+        "CREATE INDEX IF NOT EXISTS ix_phone_number_normalized ON phone (number_normalized varchar_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_email_address_normalized ON email (address_normalized varchar_pattern_ops)",
+    ]),
+    (6, [
+        # Проверка дубликатов в книгах команд
+        "CREATE INDEX IF NOT EXISTS ix_contragent_team_inn ON contragent (team_id, inn_normalized)",
+        "CREATE INDEX IF NOT EXISTS ix_contragent_team_org_name ON contragent (team_id, org_name_normalized)",
+    ]),
+    (7, [
+        backfill_phones_normalized,
+    ]),
+    (8, [
+        backfill_international_phones,
+    ]),
+    (9, [
+        # Старые токены восстановления хранились в user открытым текстом. Колонки больше
+        # не используются, но удалять их сразу нельзя - их еще читают экземпляры
+        # предыдущей версии во время выкатки; стираем сами токены
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = current_schema() AND table_name = 'user'
+                         AND column_name = 'reset_token') THEN
+                UPDATE "user" SET reset_token = NULL, reset_token_expires = NULL
+                WHERE reset_token IS NOT NULL OR reset_token_expires IS NOT NULL;
+            END IF;
+        END $$
+        """,
+    ]),
+]
+
+# Ключ advisory-блокировки, чтобы миграции не применялись параллельно несколькими воркерами
+SCHEMA_MIGRATION_LOCK_ID = 7425001
+
+# Доступно ли расширение pg_trgm (определяется при старте)
+pg_trgm_available = False
+
+def enable_pg_trgm():
+    """
+    Ошибка соединения пробрасывается - инициализация повторится целиком.
+    Нет прав на CREATE EXTENSION - работаем без триграммных индексов,
+    если расширение не установлено администратором заранее.
+    """
+    global pg_trgm_available
+    with db.engine.begin() as conn:
+        try:
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        except DBAPIError as e:
+            if e.connection_invalidated:
+                raise
+            print(f"⚠️  Не удалось создать расширение pg_trgm: {e}")
+        pg_trgm_available = conn.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        ).first() is not None
+    if not pg_trgm_available:
+        print("⚠️  Расширение pg_trgm недоступно, поиск похожих названий без индекса")
+
+# Триграммные индексы создаются только при наличии pg_trgm
+TRGM_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_contragent_org_name_trgm ON contragent USING gin (org_name_normalized gin_trgm_ops)",
+    # Поиск подстроки в подсказках: lower(col) LIKE '%abc%'
+    "CREATE INDEX IF NOT EXISTS ix_contragent_org_name_lower_trgm ON contragent USING gin (lower(org_name) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_contragent_contact_lower_trgm ON contragent USING gin (lower(contact_person) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_phone_number_lower_trgm ON phone USING gin (lower(number) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_email_address_lower_trgm ON email USING gin (lower(address) gin_trgm_ops)",
+    # Подсказки по телефонам и email ищут подстроку в нормализованных колонках
+    "CREATE INDEX IF NOT EXISTS ix_phone_number_normalized_trgm ON phone USING gin (number_normalized gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_email_address_normalized_trgm ON email USING gin (address_normalized gin_trgm_ops)",
+]
+
+def apply_schema_migrations():
+    if db.engine.dialect.name != 'postgresql':
+        # На других СУБД (локальные проверки) схема целиком создается через create_all
+        return
+
+    enable_pg_trgm()
+
+    # Сессионная блокировка держится на все время миграций, поэтому шаги
+    # могут фиксировать свою работу порциями, не пуская параллельно другие воркеры
+    with db.engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:lock_id)"), {'lock_id': SCHEMA_MIGRATION_LOCK_ID})
+        conn.commit()
+        try:
+            for version, steps in SCHEMA_MIGRATIONS:
+                if conn.execute(select(SchemaMigration.version).where(SchemaMigration.version == version)).first():
+                    conn.rollback()
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(text(step))
+                conn.execute(insert(SchemaMigration.__table__).values(version=version, applied_at=datetime.utcnow()))
+                conn.commit()
+                print(f"✅ Применена миграция схемы {version}")
+        except Exception:
+            # Закрываем соединение совсем - сервер снимет блокировку вместе с ним
+            conn.invalidate()
+            raise
+        conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {'lock_id': SCHEMA_MIGRATION_LOCK_ID})
+        conn.commit()
+
+    if pg_trgm_available:
+        with db.engine.begin() as conn:
+            for statement in TRGM_INDEXES:
+                conn.execute(text(statement))
+
+def get_schema_version():
+    return db.session.execute(select(func.max(SchemaMigration.version))).scalar() or 0
+
+@app.cli.command('backfill-contacts')
+@click.option('--batch-size', default=1000, type=int, help='Строк в одной транзакции')
+def backfill_contacts_command(batch_size):
+    """Пересчитывает нормализованные телефоны и email у существующих записей."""
+    setup_database()
+    # Каждая порция - отдельная транзакция, чтобы не держать блокировки на всей таблице
+    with db.engine.connect() as conn:
+        totals = backfill_contacts_normalized(conn, batch_size=batch_size)
+    for table_name, total in totals.items():
+        print(f"✅ {table_name}: обработано строк {total}")
+
+# ========== ПОИСК ДУБЛИКАТОВ ==========
+
+def find_duplicate_contragents(user_id, team_ids, inn, org_name, limit=5):
+    """
+    Контрагенты с тем же ИНН или тем же нормализованным наименованием во всех книгах,
+    которые видит пользователь: личной и книгах команд team_ids (записи коллег тоже).
+    Условия покрываются индексами (user_id, ...) и (team_id, ...) по inn_normalized и org_name_normalized.
+    """
+    conditions = []
+    inn_normalized = normalize_inn(inn)
+    org_name_normalized = normalize_org_name(org_name)
+    if inn_normalized:
+        conditions.append(Contragent.inn_normalized == inn_normalized)
+    if org_name_normalized:
+        conditions.append(Contragent.org_name_normalized == org_name_normalized)
+    if not conditions:
+        return []
+    return Contragent.query.filter(
+        contragent_access_condition(user_id, team_ids),
+        Contragent.deleted_at.is_(None),
+        or_(*conditions)
+    ).order_by(Contragent.id.desc()).limit(limit).all()
+
+def similar_org_name_pairs(user_id, threshold, limit):
+    """
+    Пары контрагентов с похожими наименованиями. С pg_trgm используется
+    триграммный индекс, иначе - сравнение соседей в отсортированном списке.
+    """
+    if pg_trgm_available:
+        # Оператор % отсекает пары по pg_trgm.similarity_threshold (по умолчанию 0.3) -
+        # без этого порог ниже 0.3 молча работал бы как 0.3
+        db.session.execute(text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+                           {'threshold': str(threshold)})
+        rows = db.session.execute(text("""
+            SELECT a.id AS id_a, b.id AS id_b, similarity(a.org_name_normalized, b.org_name_normalized) AS score
+            FROM contragent a
+            JOIN contragent b
+              ON b.user_id = a.user_id
+             AND b.id > a.id
+             AND a.org_name_normalized % b.org_name_normalized
+            WHERE a.user_id = :user_id
+              AND a.deleted_at IS NULL
+              AND b.deleted_at IS NULL
+              AND similarity(a.org_name_normalized, b.org_name_normalized) >= :threshold
+            ORDER BY score DESC
+            LIMIT :limit
+        """), {'user_id': user_id, 'threshold': threshold, 'limit': limit}).all()
+        return [(row.id_a, row.id_b, float(row.score)) for row in rows]
+
+    rows = db.session.execute(
+        select(Contragent.id, Contragent.org_name_normalized)
+        .where(Contragent.user_id == user_id, Contragent.deleted_at.is_(None),
+               Contragent.org_name_normalized.isnot(None))
+        .order_by(Contragent.org_name_normalized)
+    ).all()
+    window = 5
+    pairs = []
+    for i, row in enumerate(rows):
+        for other in rows[i + 1:i + window]:
+            score = difflib.SequenceMatcher(None, row.org_name_normalized, other.org_name_normalized).ratio()
+            if score >= threshold:
+                pairs.append((min(row.id, other.id), max(row.id, other.id), score))
+    pairs.sort(key=lambda pair: pair[2], reverse=True)
+    return pairs[:limit]
+
+def build_duplicates_report(user_id, threshold=0.6, limit=500, progress=None):
+    """
+    Отчет о дубликатах пользователя: группы с одинаковым ИНН и пары похожих наименований.
+    progress(done, total) вызывается между этапами (фоновое задание проверяет там отмену).
+    """
+    active = and_(Contragent.user_id == user_id, Contragent.deleted_at.is_(None))
+    duplicate_inns = (
+        select(Contragent.inn_normalized)
+        .where(active, Contragent.inn_normalized.isnot(None))
+        .group_by(Contragent.inn_normalized)
+        .having(func.count(Contragent.id) > 1)
+        .limit(limit)
+    )
+    # Участники всех групп - одним запросом, а не отдельным на каждый ИНН
+    members = db.session.execute(
+        select(Contragent.id, Contragent.org_name, Contragent.inn_normalized)
+        .where(active, Contragent.inn_normalized.in_(duplicate_inns))
+        .order_by(Contragent.inn_normalized, Contragent.id)
+    ).all()
+
+    groups = {}
+    for member in members:
+        groups.setdefault(member.inn_normalized, []).append({'id': member.id, 'org_name': member.org_name})
+    groups = [{'inn': inn, 'contragents': contragents} for inn, contragents in groups.items()]
+    if progress:
+        progress(1, 3)
+
+    pairs = similar_org_name_pairs(user_id, threshold, limit)
+    if progress:
+        progress(2, 3)
+    names = {}
+    ids = {contragent_id for pair in pairs for contragent_id in pair[:2]}
+    if ids:
+        names = dict(db.session.execute(
+            select(Contragent.id, Contragent.org_name).where(Contragent.id.in_(ids))
+        ).all())
+
+    return {
+        'inn_groups': groups,
+        'similar_names': [{
+            'contragents': [{'id': id_a, 'org_name': names.get(id_a)}, {'id': id_b, 'org_name': names.get(id_b)}],
+            'similarity': round(score, 3)
+        } for id_a, id_b, score in pairs]
+    }
+
+# ========== ПОДСКАЗКИ ДЛЯ ПОИСКА ==========
+
+# Поле поиска -> (колонка, дочерняя таблица для join)
+SUGGEST_FIELDS = {
+    'org_name': (Contragent.org_name, None),
+    'inn': (Contragent.inn, None),
+    'contact_person': (Contragent.contact_person, None),
+    'phones': (Phone.number_normalized, Phone),
+    'emails': (Email.address_normalized, Email),
+}
+SUGGEST_MAX_LIMIT = 20
+SUGGEST_CACHE_SIZE = 2048
+SUGGEST_CACHE_TTL = 30
+
+# (user_id, team_ids, field, query) -> (expires_at, values, complete, substring)
+suggest_cache = OrderedDict()
+suggest_cache_lock = threading.Lock()
+
+def phone_search_prefixes(query):
+    """
+    Префиксы для поиска по number_normalized. Неполный номер нельзя привести
+    к E.164 однозначно, поэтому '8 900' и '495' ищутся и как есть, и с кодом 7.
+    Запрос с '+' уже содержит код страны и ищется только как есть
+    """
+    digits = re.sub(r'\D', '', query or '')
+    if not digits:
+        return []
+    if query.lstrip().startswith('+'):
+        return [digits]
+    prefixes = {digits, normalize_phone(digits)}
+    if not digits.startswith('7'):
+        prefixes.add('7' + digits)
+    if digits.startswith('8'):
+        prefixes.add('7' + digits[1:])
+    return sorted(prefixes)
+
+def suggest_query_forms(field, query):
+    """
+    Формы запроса для подсказок. Телефоны и email сравниваются с нормализованными
+    колонками как есть (как в поиске), остальные поля - через lower(col)
+    """
+    if field == 'phones':
+        return phone_search_prefixes(query)
+    if field == 'emails':
+        return [value for value in [normalize_email(query)] if value]
+    return [query]
+
+SEARCH_TEXT_COLUMNS = {
+    'org_name': Contragent.org_name,
+    'inn': Contragent.inn,
+    'contact_person': Contragent.contact_person,
+    'position': Contragent.position,
+    'address': Contragent.address,
+}
+
+def contragent_search_condition(field, query_text):
+    """
+    SQL-условие поиска по полю field ('all' - по всем полям). Подстроки ищутся
+    через lower(col) LIKE '%...%' (на PostgreSQL - по триграммным индексам),
+    телефоны и email - точным/префиксным совпадением по нормализованным колонкам.
+    Дочерние таблицы проверяются через id IN (подзапрос), а не коррелированный EXISTS:
+    так планировщик начинает с индекса телефонов/email, а не перебирает всю книгу.
+    """
+    pattern = f'%{escape_like(query_text.lower())}%'
+    
+    def contains(column):
+        return func.lower(column).like(pattern, escape='\\')
+    
+    def child_matches(model, condition):
+        return Contragent.id.in_(select(model.contragent_id).where(condition))
+    
+    if field in SEARCH_TEXT_COLUMNS:
+        return contains(SEARCH_TEXT_COLUMNS[field])
+    if field == 'phones':
+        prefixes = phone_search_prefixes(query_text)
+        if not prefixes:
+            return false()
+        # Точное или префиксное совпадение по индексу number_normalized
+        return child_matches(Phone, or_(*[Phone.number_normalized.like(f'{prefix}%') for prefix in prefixes]))
+    if field == 'emails':
+        email_pattern = f"{escape_like(normalize_email(query_text) or '')}%"
+        return child_matches(Email, Email.address_normalized.like(email_pattern, escape='\\'))
+    if field == 'websites':
+        return child_matches(Website, contains(Website.url))
+    
+    phone_conditions = [contains(Phone.number)]
+    phone_conditions += [Phone.number_normalized.like(f'{prefix}%') for prefix in phone_search_prefixes(query_text)]
+    return or_(
+        *[contains(column) for column in SEARCH_TEXT_COLUMNS.values()],
+        child_matches(Phone, or_(*phone_conditions)),
+        child_matches(Email, contains(Email.address)),
+        child_matches(Website, contains(Website.url))
+    )
+
+def search_contragents(user_id, team_ids, field, query_text, before_id=None, limit=None):
+    """
+    Страница результатов поиска (новые первыми) - фильтрация целиком в SQL
+    """
+    stmt = select(Contragent).where(
+        contragent_access_condition(user_id, team_ids),
+        Contragent.deleted_at.is_(None),
+        contragent_search_condition(field, query_text)
+    )
+    if before_id is not None:
+        stmt = stmt.where(Contragent.id < before_id)
+    stmt = stmt.options(
+        selectinload(Contragent.phones),
+        selectinload(Contragent.emails),
+        selectinload(Contragent.websites)
+    ).order_by(Contragent.id.desc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return db.session.execute(stmt).scalars().all()
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def query_suggestions(user_id, team_ids, field, query, limit, substring):
+    column, child = SUGGEST_FIELDS[field]
+    forms = suggest_query_forms(field, query)
+    if not forms:
+        return []
+    patterns = [f'%{escape_like(form)}%' if substring else f'{escape_like(form)}%' for form in forms]
+    # Нормализованные колонки уже в нижнем регистре - lower() помешал бы индексу
+    compared = column if child is not None else func.lower(column)
+    
+    stmt = select(column).select_from(Contragent)
+    if child is not None:
+        stmt = stmt.join(child)
+    stmt = (stmt.where(contragent_access_condition(user_id, team_ids),
+                       Contragent.deleted_at.is_(None),
+                       or_(*[compared.like(pattern, escape='\\') for pattern in patterns]))
+            .distinct()
+            .order_by(column)
+            .limit(limit))
+    return [value for value in db.session.execute(stmt).scalars() if value]
+
+def cached_suggestions(key, query, substring):
+    """
+    Ищет в кэше ответ для query или для его префикса. Полный ответ (меньше лимита)
+    для 'ром' содержит все ответы для 'рома' - их достаточно отфильтровать.
+    """
+    user_id, team_ids, field, _ = key
+    now = time.monotonic()
+    with suggest_cache_lock:
+        for length in range(len(query), 0, -1):
+            entry = suggest_cache.get((user_id, team_ids, field, query[:length]))
+            if not entry or entry[0] < now:
+                continue
+            expires_at, values, complete, entry_substring = entry
+            if length == len(query):
+                suggest_cache.move_to_end(key)
+                return values
+            if complete and (entry_substring or not substring):
+                forms = suggest_query_forms(field, query)
+                if substring:
+                    return [v for v in values if any(form in v.lower() for form in forms)]
+                return [v for v in values if any(v.lower().startswith(form) for form in forms)]
+    return None
+
+def get_suggestions(user_id, team_ids, field, query, limit):
+    # Поиск подстроки по триграммному индексу имеет смысл от 3 символов
+    substring = pg_trgm_available and len(query) >= 3
+    key = (user_id, tuple(sorted(team_ids)), field, query)
+    
+    values = cached_suggestions(key, query, substring)
+    if values is None:
+        values = query_suggestions(user_id, team_ids, field, query, SUGGEST_MAX_LIMIT, substring=False)
+        if substring and len(values) < SUGGEST_MAX_LIMIT:
+            for value in query_suggestions(user_id, team_ids, field, query, SUGGEST_MAX_LIMIT, substring=True):
+                if value not in values and len(values) < SUGGEST_MAX_LIMIT:
+                    values.append(value)
+        with suggest_cache_lock:
+            suggest_cache[key] = (time.monotonic() + SUGGEST_CACHE_TTL, values,
+                                  len(values) < SUGGEST_MAX_LIMIT, substring)
+            suggest_cache.move_to_end(key)
+            while len(suggest_cache) > SUGGEST_CACHE_SIZE:
+                suggest_cache.popitem(last=False)
+    
+    return values[:limit]
+
+# ========== ЖУРНАЛ ИЗМЕНЕНИЙ ==========
+# Записи копятся в памяти процесса и пачками пишутся в audit_log фоновым потоком,
+# чтобы сохранение контрагента не ждало лишнего INSERT.
+
+AUDIT_FIELDS = ['org_name', 'inn', 'contact_person', 'position', 'address']
+AUDIT_BATCH_SIZE = 500
+
+audit_buffer = queue.Queue(maxsize=app.config['AUDIT_BUFFER_SIZE'])
+audit_flush_lock = threading.Lock()
+# Пачка, которую не удалось записать: при следующем сбросе пишется первой
+audit_failed_batch = []
+# До этого момента (time.monotonic) после ошибки базы журнал не сбрасываем
+audit_retry_at = 0.0
+# Сколько записей потеряно: база недоступна, а буфер заполнен (видно в /readyz)
+audit_dropped = 0
+audit_dropped_lock = threading.Lock()
+
+def audit_snapshot(fields, phones, emails, websites):
+    snapshot = {field: fields.get(field) or None for field in AUDIT_FIELDS}
+    snapshot['phones'] = list(phones)
+    snapshot['emails'] = list(emails)
+    snapshot['websites'] = list(websites)
+    return snapshot
+
+def contragent_snapshot(contragent):
+    return audit_snapshot(
+        {field: getattr(contragent, field) for field in AUDIT_FIELDS},
+        [phone.number for phone in contragent.phones],
+        [email.address for email in contragent.emails],
+        [website.url for website in contragent.websites]
+    )
+
+def diff_snapshots(old, new):
+    """
+    Изменения по полям: {'inn': {'old': ..., 'new': ...}}. Для создания old пустой,
+    для удаления - new.
+    """
+    changes = {}
+    for key in set(old) | set(new):
+        old_value, new_value = old.get(key), new.get(key)
+        if old_value != new_value and (old_value or new_value):
+            changes[key] = {'old': old_value, 'new': new_value}
+    return changes
+
+def record_audit(user_id, contragent_id, action, changes):
+    if not changes:
+        return
+    entry = {
+        'user_id': user_id,
+        'contragent_id': contragent_id,
+        'action': action,
+        'changes': json.dumps(changes, ensure_ascii=False),
+        'created_at': datetime.utcnow(),
+    }
+    global audit_dropped
+    try:
+        audit_buffer.put_nowait(entry)
+        return
+    except queue.Full:
+        # Буфер переполнен - сбрасываем его прямо в запросе
+        flush_audit_log()
+    try:
+        audit_buffer.put_nowait(entry)
+    except queue.Full:
+        # База не принимает записи дольше, чем помещается в буфер - запись теряется
+        with audit_dropped_lock:
+            audit_dropped += 1
+        print(f"⚠️  Буфер журнала изменений переполнен, запись для контрагента {contragent_id} потеряна")
+
+def flush_audit_log(force=False):
+    """
+    Пишет буфер журнала пачками. Если база не ответила, пачка сохраняется
+    для следующей попытки, а новые попытки откладываются на AUDIT_RETRY_INTERVAL.
+    """
+    global audit_failed_batch, audit_retry_at
+    with audit_flush_lock:
+        if not force and time.monotonic() < audit_retry_at:
+            return
+        while True:
+            batch = audit_failed_batch
+            while len(batch) < AUDIT_BATCH_SIZE:
+                try:
+                    batch.append(audit_buffer.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(insert(AuditLog.__table__), batch)
+            except Exception as e:
+                audit_failed_batch = batch
+                audit_retry_at = time.monotonic() + app.config['AUDIT_RETRY_INTERVAL']
+                print(f"❌ Не удалось записать журнал изменений ({len(batch)} записей), повтор позже: {e}")
+                return
+            audit_failed_batch = []
+            audit_retry_at = 0.0
+
+def flush_audit_log_at_exit():
+    if audit_failed_batch or not audit_buffer.empty():
+        with app.app_context():
+            flush_audit_log(force=True)
+
+atexit.register(flush_audit_log_at_exit)
+
+# ========== ФОНОВЫЕ ЗАДАНИЯ (ОЧЕРЕДЬ В БД) ==========
+# Долгие операции ставятся в таблицу job и выполняются процессами,
+# запущенными командой `flask --app app run-jobs`, вне HTTP-запросов.
+
+# Задание считается зависшим, если воркер не отмечался столько секунд
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 600))
+# Как часто выполняющееся задание отмечается живым, даже если обработчик занят одним долгим запросом
+JOB_HEARTBEAT_SECONDS = int(os.environ.get('JOB_HEARTBEAT_SECONDS', 30))
+JOB_IMPORT_MAX_ROWS = 50000
+
+class JobCancelled(Exception):
+    def __init__(self, result=None):
+        super().__init__()
+        # Что успело выполниться до отмены (например, число импортированных строк)
+        self.result = result
+
+class JobContext:
+    """
+    То, что получает обработчик задания: параметры и способ сообщить прогресс.
+    report_progress заодно проверяет, не попросили ли задание отменить.
+    """
+    def __init__(self, job_id, user_id, params):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.params = params
+
+    def report_progress(self, done, total):
+        progress = int(done * 100 / total) if total else 100
+        jobs = Job.__table__
+        with db.engine.begin() as conn:
+            row = conn.execute(
+                update(jobs)
+                .where(jobs.c.id == self.job_id, jobs.c.status == 'running')
+                .values(progress=min(progress, 99), heartbeat_at=datetime.utcnow())
+                .returning(jobs.c.cancel_requested)
+            ).first()
+        # Задание больше не выполняется (например, признано зависшим) - продолжать незачем
+        if row is None or row.cancel_requested:
+            raise JobCancelled()
+
+def job_team_ids(user_id):
+    return list(db.session.execute(
+        select(TeamMember.team_id).where(TeamMember.user_id == user_id)
+    ).scalars())
+
+def run_duplicates_report_job(ctx):
+    return build_duplicates_report(ctx.user_id, threshold=float(ctx.params.get('threshold', 0.6)),
+                                   progress=ctx.report_progress)
+
+def run_export_job(ctx, batch_size=500):
+    """
+    Экспорт всех доступных пользователю контрагентов порциями по id.
+    Каждая порция пишется отдельной строкой job_result_chunk в своей транзакции,
+    поэтому ни воркер, ни веб-сервер не держат в памяти всю книгу; в job.result -
+    только число записей и ссылка на выгрузку (/api/jobs/<id>/export).
+    """
+    chunks = JobResultChunk.__table__
+    condition = and_(contragent_access_condition(ctx.user_id, job_team_ids(ctx.user_id)),
+                     Contragent.deleted_at.is_(None))
+    total = db.session.execute(select(func.count(Contragent.id)).where(condition)).scalar()
+    exported = 0
+    seq = 0
+    last_id = 0
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(delete(chunks).where(chunks.c.job_id == ctx.job_id))
+        while True:
+            batch = db.session.execute(
+                select(Contragent)
+                .where(condition, Contragent.id > last_id)
+                .options(selectinload(Contragent.phones),
+                         selectinload(Contragent.emails),
+                         selectinload(Contragent.websites))
+                .order_by(Contragent.id)
+                .limit(batch_size)
+            ).scalars().all()
+            if not batch:
+                break
+            data = json.dumps([{'id': contragent.id, **contragent_snapshot(contragent)} for contragent in batch],
+                              ensure_ascii=False, default=str)
+            with db.engine.begin() as conn:
+                conn.execute(insert(chunks).values(job_id=ctx.job_id, seq=seq, data=data))
+            seq += 1
+            exported += len(batch)
+            last_id = batch[-1].id
+            db.session.expunge_all()
+            ctx.report_progress(exported, total)
+    except BaseException:
+        # Незавершенная выгрузка никому не нужна
+        with db.engine.begin() as conn:
+            conn.execute(delete(chunks).where(chunks.c.job_id == ctx.job_id))
+        raise
+    # Воркер заданий работает вне HTTP-запроса - ссылку собираем без url_for
+    return {'count': exported, 'chunks': seq, 'download': f'/api/jobs/{ctx.job_id}/export'}
+
+def run_import_job(ctx, batch_size=200):
+    """
+    Импорт контрагентов из params['contragents'] порциями, каждая в своей транзакции
+    """
+    rows = ctx.params.get('contragents') or []
+    team_id = ctx.params.get('team_id')
+    imported = 0
+    for start in range(0, len(rows), batch_size):
+        for row in rows[start:start + batch_size]:
+            org_name = str(row.get('org_name') or '').strip()
+            if not org_name:
+                continue
+            db.session.add(Contragent(
+                org_name=org_name[:200],
+                inn=str(row.get('inn') or '').strip()[:20] or None,
+                contact_person=str(row.get('contact_person') or '').strip()[:100] or None,
+                position=str(row.get('position') or '').strip()[:100] or None,
+                address=str(row.get('address') or '').strip()[:300] or None,
+                user_id=ctx.user_id,
+                team_id=team_id,
+                phones=[Phone(number=str(v).strip()[:50]) for v in row.get('phones') or [] if str(v).strip()],
+                emails=[Email(address=str(v).strip()[:120]) for v in row.get('emails') or [] if str(v).strip()],
+                websites=[Website(url=str(v).strip()[:200]) for v in row.get('websites') or [] if str(v).strip()]
+            ))
+            imported += 1
+        db.session.commit()
+        db.session.expunge_all()
+        try:
+            ctx.report_progress(min(start + batch_size, len(rows)), len(rows))
+        except JobCancelled:
+            # Зафиксированные порции остаются в базе - сообщаем, сколько их
+            raise JobCancelled(result={'imported': imported})
+    return {'imported': imported}
+
+def run_reindex_job(ctx, batch_size=1000):
+    """
+    Пересчитывает нормализованные колонки контрагентов пользователя
+    """
+    table = Contragent.__table__
+    total = db.session.execute(select(func.count(table.c.id)).where(table.c.user_id == ctx.user_id)).scalar()
+    done = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.inn, table.c.org_name)
+                .where(table.c.user_id == ctx.user_id, table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            conn.execute(
+                update(table).where(table.c.id == bindparam('row_id')),
+                [{'row_id': row.id,
+                  'inn_normalized': normalize_inn(row.inn),
+                  'org_name_normalized': normalize_org_name(row.org_name)} for row in rows]
+            )
+        done += len(rows)
+        last_id = rows[-1].id
+        ctx.report_progress(done, total)
+    return {'reindexed': done}
+
+JOB_HANDLERS = {
+    'duplicates_report': run_duplicates_report_job,
+    'export': run_export_job,
+    'import': run_import_job,
+    'reindex': run_reindex_job,
+}
+
+def claim_next_job():
+    """
+    Забирает следующее задание из очереди. SKIP LOCKED позволяет нескольким
+    процессам разбирать очередь параллельно, не мешая друг другу.
+    """
+    jobs = Job.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        job_id = conn.execute(
+            select(jobs.c.id)
+            .where(jobs.c.status == 'queued')
+            .order_by(jobs.c.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalar()
+        if job_id is None:
+            return None
+        # Условие на статус страхует от двойного захвата там, где FOR UPDATE не поддерживается (SQLite)
+        claimed = conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'queued')
+                               .values(status='running', started_at=now, heartbeat_at=now))
+        if claimed.rowcount != 1:
+            return None
+        return conn.execute(select(jobs.c.id, jobs.c.user_id, jobs.c.kind, jobs.c.params)
+                            .where(jobs.c.id == job_id)).first()
+
+def finish_job(job_id, status, result=None, error=None):
+    jobs = Job.__table__
+    values = {'status': status, 'finished_at': datetime.utcnow(), 'error': error}
+    if status == 'done':
+        values['progress'] = 100
+    if result is not None:
+        values['result'] = json.dumps(result, ensure_ascii=False, default=str)
+    with db.engine.begin() as conn:
+        # Уже завершенное задание (отменено, признано зависшим) не перезаписываем
+        conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running').values(**values))
+
+def job_heartbeat(job_id, stop):
+    jobs = Job.__table__
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running')
+                                 .values(heartbeat_at=datetime.utcnow()))
+        except Exception as e:
+            print(f"⚠️  Не удалось отметить задание {job_id}: {e}")
+
+def run_job(job):
+    ctx = JobContext(job.id, job.user_id, json.loads(job.params or '{}'))
+    handler = JOB_HANDLERS.get(job.kind)
+    # Отметки идут из отдельного потока: зависшим считается только задание умершего воркера
+    heartbeat_stop = threading.Event()
+    threading.Thread(target=job_heartbeat, args=(job.id, heartbeat_stop),
+                     name=f'job-{job.id}-heartbeat', daemon=True).start()
+    try:
+        if handler is None:
+            raise ValueError(f'Неизвестный тип задания: {job.kind}')
+        result = handler(ctx)
+        finish_job(job.id, 'done', result=result)
+        print(f"✅ Задание {job.id} ({job.kind}) выполнено")
+    except JobCancelled as e:
+        db.session.rollback()
+        finish_job(job.id, 'cancelled', result=e.result)
+        print(f"ℹ️  Задание {job.id} ({job.kind}) отменено")
+    except Exception as e:
+        db.session.rollback()
+        finish_job(job.id, 'failed', error=str(e))
+        print(f"❌ Задание {job.id} ({job.kind}) завершилось ошибкой: {e}")
+    finally:
+        heartbeat_stop.set()
+        db.session.remove()
+
+def fail_stale_jobs():
+    jobs = Job.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    with db.engine.begin() as conn:
+        conn.execute(update(jobs)
+                     .where(jobs.c.status == 'running', jobs.c.heartbeat_at < cutoff)
+                     .values(status='failed', finished_at=datetime.utcnow(),
+                             error='Воркер перестал отвечать'))
+
+def job_worker_loop(poll_interval):
+    with app.app_context():
+        # Процесс получен через fork - соединения родителя не используем
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+        print(f"🚀 Воркер заданий запущен (pid {os.getpid()})")
+        while True:
+            try:
+                fail_stale_jobs()
+                job = claim_next_job()
+            except Exception as e:
+                print(f"⚠️  Ошибка очереди заданий: {e}")
+                job = None
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_job(job)
+
+def default_job_worker_processes():
+    # Не больше CPU контейнера (с учетом квоты cgroup); каждый процесс - еще соединение с базой
+    return int(os.environ.get('JOB_WORKER_PROCESSES', min(available_cpus(), 4)))
+
+@app.cli.command('run-jobs')
+@click.option('--processes', default=default_job_worker_processes,
+              type=int, help='Число процессов-воркеров')
+@click.option('--poll-interval', default=2.0, type=float, help='Пауза между опросами пустой очереди, сек')
+def run_jobs_command(processes, poll_interval):
+    """Запускает процессы, выполняющие фоновые задания из таблицы job."""
+    setup_database()
+    if processes <= 1:
+        job_worker_loop(poll_interval)
+        return
+    workers = [multiprocessing.Process(target=job_worker_loop, args=(poll_interval,), daemon=True)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+# ========== СЕРВЕРНЫЕ СЕССИИ ==========
+
+session_serializer = TaggedJSONSerializer()
+session_table = UserSession.__table__
+
+class ServerSideSession(SessionMixin):
+    """
+    Сессия, данные которой хранятся в БД. Строка читается только при первом
+    обращении к сессии, поэтому запросы, которые ее не трогают, не ходят в БД.
+    """
+    def __init__(self, sid=None):
+        self.sid = sid
+        self.modified = False
+        self.accessed = False
+        self.regenerated_from = None
+        self.expires_at = None
+        self._data = None
+
+    def _load(self):
+        self.accessed = True
+        if self._data is not None:
+            return self._data
+        self._data = {}
+        if self.sid:
+            row = db.session.execute(
+                select(session_table.c.data, session_table.c.expires_at).where(
+                    session_table.c.id == self.sid,
+                    session_table.c.expires_at > datetime.utcnow()
+                ),
+                bind_arguments={'bind': db.engine}
+            ).first()
+            if row:
+                self._data = session_serializer.loads(row.data)
+                self.expires_at = row.expires_at
+            else:
+                # Сессия истекла или отозвана - выдадим новую при записи
+                self.sid = None
+        return self._data
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def regenerate(self):
+        """
+        Выдает новый id сессии и удаляет старую строку (вход и выход из системы)
+        """
+        self._load()
+        if self.sid:
+            self.regenerated_from = self.sid
+        self.sid = None
+        self.modified = True
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+class DatabaseSessionInterface(SessionInterface):
+    def open_session(self, app, request):
+        return ServerSideSession(request.cookies.get(self.get_cookie_name(app)))
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            # К сессии не обращались - ни записи в БД, ни нового cookie
+            return
+
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        # Продлеваем сессию не чаще раза в сутки, а не на каждом запросе
+        refresh_due = (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']
+                       and session.expires_at is not None
+                       and session.expires_at < now + lifetime - timedelta(days=1))
+
+        if not session.modified and not session.regenerated_from and not refresh_due:
+            # Ничего не изменилось и продлевать рано - соединение для записи не берем
+            return
+
+        with db.engine.begin() as conn:
+            if session.regenerated_from:
+                conn.execute(delete(session_table).where(session_table.c.id == session.regenerated_from))
+
+            if not session:
+                if session.sid:
+                    conn.execute(delete(session_table).where(session_table.c.id == session.sid))
+                if session.sid or session.regenerated_from:
+                    response.delete_cookie(cookie_name, domain=domain, path=path)
+                return
+
+            values = {
+                'user_id': session.get('user_id'),
+                'data': session_serializer.dumps(dict(session)),
+                'expires_at': now + lifetime,
+            }
+
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(24)
+                conn.execute(insert(session_table).values(id=session.sid, **values))
+            elif session.modified:
+                conn.execute(update(session_table).where(session_table.c.id == session.sid).values(**values))
+            elif refresh_due:
+                # Условие на expires_at - параллельные запросы продлевают сессию один раз
+                result = conn.execute(
+                    update(session_table).where(
+                        session_table.c.id == session.sid,
+                        session_table.c.expires_at < now + lifetime - timedelta(days=1)
+                    ).values(expires_at=now + lifetime)
+                )
+                if result.rowcount == 0:
+                    return
+            else:
+                return
+
+        response.set_cookie(
+            cookie_name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+def revoke_user_sessions(user_id, keep_sid=None):
+    """
+    Отзывает все сессии пользователя (кроме keep_sid) сразу во всех воркерах
+    """
+    condition = session_table.c.user_id == user_id
+    if keep_sid:
+        condition = condition & (session_table.c.id != keep_sid)
+    with db.engine.begin() as conn:
+        conn.execute(delete(session_table).where(condition))
+
+def cleanup_expired_sessions():
+    deleted = delete_in_batches(session_table, session_table.c.expires_at < datetime.utcnow())
+    if deleted:
+        print(f"🧹 Удалено истекших сессий: {deleted}")
+
+def cleanup_expired_reset_tokens():
+    table = PasswordResetToken.__table__
+    deleted = delete_in_batches(table, table.c.expires_at < datetime.utcnow())
+    if deleted:
+        print(f"🧹 Удалено истекших токенов восстановления: {deleted}")
+
+def regenerate_session():
+    if isinstance(session._get_current_object(), ServerSideSession):
+        session.regenerate()
+
+if app.config['SESSION_STORE'] == 'database':
+    app.session_interface = DatabaseSessionInterface()
+
+# ========== ДОСТУП К ОБЩИМ КНИГАМ ==========
+
+def get_acl():
+    """
+    Роли текущего пользователя в командах {team_id: role}.
+    Загружаются одним запросом по индексу team_member.user_id и кэшируются до конца HTTP-запроса.
+    """
+    if 'acl' not in g:
+        g.acl = dict(db.session.execute(
+            select(TeamMember.team_id, TeamMember.role).where(TeamMember.user_id == session['user_id'])
+        ).all())
+    return g.acl
+
+def readable_team_ids():
+    return list(get_acl())
+
+def writable_team_ids():
+    return [team_id for team_id, role in get_acl().items() if role in TEAM_WRITE_ROLES]
+
+def writable_teams():
+    """Команды, в книги которых пользователь может добавлять записи (для выбора в форме)"""
+    team_ids = writable_team_ids()
+    return Team.query.filter(Team.id.in_(team_ids)).order_by(Team.name).all() if team_ids else []
+
+def contragent_access_condition(user_id, team_ids):
+    """
+    Условие доступа: личная книга пользователя или книги команд team_ids
+    """
+    return or_(and_(Contragent.team_id.is_(None), Contragent.user_id == user_id),
+               Contragent.team_id.in_(team_ids))
 
 # ========== ДЕКОРАТОРЫ И ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 
@@ -449,37 +2122,147 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+# Декоратор для маршрутов, которые только читают данные
+def replica_read(f):
+    def decorated_function(*args, **kwargs):
+        if not replica_keys or time.time() - session.get('db_write_at', 0) < replica_sticky_seconds:
+            return f(*args, **kwargs)
+        
+        g.db_use_replica = True
+        g.pop('db_replica_failed', None)
+        try:
+            return f(*args, **kwargs)
+        except OperationalError as e:
+            g.pop('db_replica_key', None)
+            # Ошибки основной базы (или блокировки при загрузке сессии) реплику не касаются
+            failed_key = g.pop('db_replica_failed', None)
+            if failed_key is None:
+                raise
+            # Реплика недоступна - временно исключаем ее и повторяем запрос на основной базе
+            print(f"⚠️  Реплика {failed_key} недоступна, читаем из основной базы: {e}")
+            with replica_lock:
+                replica_down_until[failed_key] = time.monotonic() + replica_retry_seconds
+            db.session.rollback()
+            g.db_use_replica = False
+            return f(*args, **kwargs)
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
 # Флаг для отслеживания инициализации БД
 database_initialized = False
+# Процесс, в котором запущены фоновые задачи (потоки не переживают fork)
+background_tasks_pid = None
+# Блокировка, чтобы при gthread/gevent воркерах таблицы создавал только один поток
+database_init_lock = threading.Lock()
+
+def setup_database():
+    """
+    Создает таблицы, применяет миграции и заводит тестового пользователя.
+    При preload_app вызывается в мастер-процессе gunicorn один раз до fork.
+    """
+    global database_initialized
+    print("🔄 Создание таблиц в базе данных PostgreSQL...")
+    with app.app_context():
+        # Таблицы создаем только в основной базе - реплики получают их репликацией
+        db.create_all(bind_key=None)
+        apply_schema_migrations()
+        print("✅ Таблицы PostgreSQL созданы")
+        
+        # Создаем тестового пользователя, если нет пользователей
+        if User.query.count() == 0:
+            test_user = User(username='admin', email='admin@example.com')
+            test_user.set_password('admin123')
+            db.session.add(test_user)
+            db.session.commit()
+            print("✅ Создан тестовый пользователь PostgreSQL:")
+            print("   Логин: admin")
+            print("   Пароль: admin123")
+        else:
+            print(f"ℹ️  В базе PostgreSQL уже есть {User.query.count()} пользователей")
+    
+    database_initialized = True
+
+def start_background_tasks():
+    global background_tasks_pid
+    if app.config['SESSION_STORE'] == 'database':
+        start_periodic_task('session-cleanup', app.config['SESSION_CLEANUP_INTERVAL'], cleanup_expired_sessions,
+                        singleton=True)
+    start_periodic_task('reset-token-cleanup', app.config['RESET_TOKEN_CLEANUP_INTERVAL'],
+                        cleanup_expired_reset_tokens, singleton=True)
+    # Буфер журнала свой в каждом процессе - сбрасывает каждый воркер
+    start_periodic_task('audit-flush', app.config['AUDIT_FLUSH_INTERVAL'], flush_audit_log)
+    start_periodic_task('contragent-purge', app.config['PURGE_INTERVAL'], purge_deleted_contragents,
+                        singleton=True)
+    background_tasks_pid = os.getpid()
+
+# Пробы не ждут инициализацию БД: /healthz не обращается к базе, а /readyz
+# запускает инициализацию в фоне (start_database_setup) и сразу отвечает 503,
+# пока она не завершится, - иначе экземпляр, к которому приходят только пробы,
+# никогда не создаст таблицы, а проба ждала бы соединений и миграций
+HEALTH_ENDPOINTS = {'healthz', 'readyz'}
+
+def run_database_setup():
+    try:
+        if not database_initialized:
+            setup_database()
+        if background_tasks_pid != os.getpid():
+            start_background_tasks()
+    except Exception as e:
+        print(f"⚠️  Ошибка при создании таблиц PostgreSQL: {e}")
+        print("⚠️  Пробуем продолжить...")
+        # Не устанавливаем флаг в True, чтобы попробовать снова при следующем запросе
+
+def start_database_setup():
+    """
+    Запускает инициализацию в фоновом потоке, если она еще не идет в этом процессе
+    """
+    if not database_init_lock.acquire(blocking=False):
+        return
+    
+    def run():
+        try:
+            run_database_setup()
+        finally:
+            database_init_lock.release()
+    
+    threading.Thread(target=run, name='database-setup', daemon=True).start()
 
 # Создаем таблицы при первом запросе
 @app.before_request
 def initialize_database():
-    global database_initialized
-    if not database_initialized:
-        try:
-            print("🔄 Создание таблиц в базе данных PostgreSQL...")
-            with app.app_context():
-                db.create_all()
-                print("✅ Таблицы PostgreSQL созданы")
-                
-                # Создаем тестового пользователя, если нет пользователей
-                if User.query.count() == 0:
-                    test_user = User(username='admin', email='admin@example.com')
-                    test_user.set_password('admin123')
-                    db.session.add(test_user)
-                    db.session.commit()
-                    print("✅ Создан тестовый пользователь PostgreSQL:")
-                    print("   Логин: admin")
-                    print("   Пароль: admin123")
-                else:
-                    print(f"ℹ️  В базе PostgreSQL уже есть {User.query.count()} пользователей")
-            
-            database_initialized = True
-        except Exception as e:
-            print(f"⚠️  Ошибка при создании таблиц PostgreSQL: {e}")
-            print("⚠️  Пробуем продолжить...")
-            # Не устанавливаем флаг в True, чтобы попробовать снова при следующем запросе
+    if request.endpoint in HEALTH_ENDPOINTS:
+        return
+    if database_initialized and background_tasks_pid == os.getpid():
+        return
+    with database_init_lock:
+        run_database_setup()
+
+# ========== ШАБЛОНЫ ==========
+# Скомпилированные шаблоны кэшируются на диске (JINJA_CACHE_DIR), поэтому новый
+# воркер не компилирует заново index.html и остальные шаблоны.
+
+jinja_cache_dir = os.environ.get('JINJA_CACHE_DIR', os.path.join(app.root_path, '.jinja_cache'))
+try:
+    os.makedirs(jinja_cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+except OSError as e:
+    print(f"⚠️  Кэш шаблонов отключен ({jinja_cache_dir}): {e}")
+
+def compile_templates():
+    """
+    Компилирует все шаблоны: байткод попадает в кэш на диске, а сами шаблоны -
+    в память процесса (при preload_app воркеры получают их от мастера через fork)
+    """
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Заранее компилирует шаблоны в кэш на диске (шаг сборки)."""
+    names = compile_templates()
+    print(f"✅ Скомпилировано шаблонов: {len(names)} -> {jinja_cache_dir}")
 
 # ========== МАРШРУТЫ ==========
 
@@ -492,6 +2275,7 @@ def set_language(lang):
 
 # Главная страница
 @app.route('/')
+@replica_read
 def index():
     lang = session.get('language', 'ru')
     t = get_translations(lang)
@@ -501,98 +2285,36 @@ def index():
     search_field = request.args.get('field', 'all')
     
     if 'user_id' in session:
-        user = db.session.get(User, session['user_id'])
+        user = get_user_by_id(session['user_id'])
         if user:
-            query = Contragent.query.filter_by(user_id=session['user_id'])
+            team_ids = readable_team_ids()
+            page_size = app.config['CONTRAGENTS_PAGE_SIZE']
+            before_id = request.args.get('before', type=int)
             
+            # Лишняя запись показывает, есть ли следующая страница
             if search_query_lower:
-                if search_field == 'all':
-                    all_contragents = query.options(
-                        db.joinedload(Contragent.phones),
-                        db.joinedload(Contragent.emails),
-                        db.joinedload(Contragent.websites)
-                    ).all()
-                    
-                    filtered_contragents = []
-                    for contragent in all_contragents:
-                        if (search_query_lower in (contragent.org_name or '').lower() or
-                            search_query_lower in (contragent.inn or '').lower() or
-                            search_query_lower in (contragent.contact_person or '').lower() or
-                            search_query_lower in (contragent.position or '').lower() or
-                            search_query_lower in (contragent.address or '').lower()):
-                            filtered_contragents.append(contragent)
-                            continue
-                        
-                        if any(search_query_lower in phone.number.lower() for phone in contragent.phones):
-                            filtered_contragents.append(contragent)
-                            continue
-                        
-                        if any(search_query_lower in email.address.lower() for email in contragent.emails):
-                            filtered_contragents.append(contragent)
-                            continue
-                        
-                        if any(search_query_lower in website.url.lower() for website in contragent.websites):
-                            filtered_contragents.append(contragent)
-                            continue
-                    
-                    contragents = sorted(filtered_contragents, key=lambda x: x.id, reverse=True)
-                    
-                    return render_template('index.html', 
-                                        contragents=contragents, 
-                                        search_query=search_query_input, 
-                                        search_field=search_field,
-                                        user=user,
-                                        t=t,
-                                        lang=lang)
-                
-                elif search_field in ['org_name', 'contact_person', 'position', 'address']:
-                    all_contragents = query.all()
-                    filtered = []
-                    
-                    if search_field == 'org_name':
-                        filtered = [c for c in all_contragents 
-                                  if c.org_name and search_query_lower in c.org_name.lower()]
-                    elif search_field == 'contact_person':
-                        filtered = [c for c in all_contragents 
-                                  if c.contact_person and search_query_lower in c.contact_person.lower()]
-                    elif search_field == 'position':
-                        filtered = [c for c in all_contragents 
-                                  if c.position and search_query_lower in c.position.lower()]
-                    elif search_field == 'address':
-                        filtered = [c for c in all_contragents 
-                                  if c.address and search_query_lower in c.address.lower()]
-                    
-                    contragents = sorted(filtered, key=lambda x: x.id, reverse=True)
-                    
-                else:
-                    if search_field == 'inn':
-                        query = query.filter(Contragent.inn.like(f'%{search_query_lower}%'))
-                    elif search_field == 'phones':
-                        query = query.join(Phone).filter(Phone.number.like(f'%{search_query_lower}%'))
-                    elif search_field == 'emails':
-                        query = query.join(Email).filter(Email.address.like(f'%{search_query_lower}%'))
-                    elif search_field == 'websites':
-                        query = query.join(Website).filter(Website.url.like(f'%{search_query_lower}%'))
-                    
-                    contragents = query.order_by(Contragent.id.desc()).all()
-                
-                return render_template('index.html', 
-                                    contragents=contragents, 
-                                    search_query=search_query_input, 
-                                    search_field=search_field,
-                                    user=user,
-                                    t=t,
-                                    lang=lang)
-            
+                contragents = search_contragents(user.id, team_ids, search_field, search_query_input,
+                                                 before_id=before_id, limit=page_size + 1)
             else:
-                contragents = query.order_by(Contragent.id.desc()).all()
-                return render_template('index.html', 
-                                    contragents=contragents, 
-                                    search_query=search_query_input, 
-                                    search_field=search_field,
-                                    user=user,
-                                    t=t,
-                                    lang=lang)
+                contragents = get_contragents_for_user(user.id, team_ids,
+                                                       before_id=before_id, limit=page_size + 1)
+            
+            next_before_id = None
+            if len(contragents) > page_size:
+                contragents = contragents[:page_size]
+                next_before_id = contragents[-1].id
+            
+            return render_template('index.html', 
+                                contragents=contragents, 
+                                search_query=search_query_input, 
+                                search_field=search_field,
+                                before_id=before_id,
+                                next_before_id=next_before_id,
+                                contragents_total=count_contragents_for_user(user.id, team_ids),
+                                user=user,
+                                writable_team_ids=writable_team_ids(),
+                                t=t,
+                                lang=lang)
     
     return render_template('index.html', 
                          contragents=[], 
@@ -621,9 +2343,10 @@ def api_login():
     username = data.get('username')
     password = data.get('password')
     
-    user = User.query.filter_by(username=username).first()
+    user = get_user_by_username(username)
     
     if user and user.check_password(password):
+        regenerate_session()
         session['user_id'] = user.id
         session.permanent = True
         return jsonify({'success': True, 'message': t['login_success']})
@@ -644,12 +2367,12 @@ def api_register():
     if email == '':
         email = None
     
-    existing_user = User.query.filter_by(username=username).first()
+    existing_user = get_user_by_username(username)
     if existing_user:
         return jsonify({'success': False, 'message': t['user_exists']})
     
     if email:
-        existing_email = User.query.filter_by(email=email).first()
+        existing_email = get_user_by_email(email)
         if existing_email:
             return jsonify({'success': False, 'message': t['email_exists']})
     
@@ -677,7 +2400,7 @@ def change_email():
     data = request.get_json()
     new_email = data.get('email', '').strip()
     
-    user = User.query.get(session['user_id'])
+    user = get_user_by_id(session['user_id'])
     
     if not new_email:
         user.email = None
@@ -704,7 +2427,7 @@ def change_password():
     current_password = data.get('current_password')
     new_password = data.get('new_password')
     
-    user = User.query.get(session['user_id'])
+    user = get_user_by_id(session['user_id'])
     
     if not user.check_password(current_password):
         return jsonify({'success': False, 'message': t['wrong_password']})
@@ -715,6 +2438,10 @@ def change_password():
     user.set_password(new_password)
     db.session.commit()
     
+    # Выходим из всех остальных сессий пользователя
+    if app.config['SESSION_STORE'] == 'database':
+        revoke_user_sessions(user.id, keep_sid=session.sid)
+    
     return jsonify({'success': True, 'message': t['password_updated']})
 
 # API для восстановления пароля
@@ -729,13 +2456,16 @@ def reset_password_request_ajax():
     if not email:
         return jsonify({'success': False, 'message': 'Пожалуйста, введите email'})
     
-    user = User.query.filter_by(email=email).first()
+    user = get_user_by_email(email)
     success_message = t['reset_password_sent']
     
     if user:
-        reset_token = str(uuid.uuid4())
-        user.reset_token = reset_token
-        user.reset_token_expires = datetime.utcnow() + timedelta(hours=1)
+        reset_token = secrets.token_urlsafe(32)
+        db.session.add(PasswordResetToken(
+            user_id=user.id,
+            token_hash=hash_reset_token(reset_token),
+            expires_at=datetime.utcnow() + timedelta(hours=1)
+        ))
         
         try:
             db.session.commit()
@@ -758,9 +2488,9 @@ def reset_password_confirm(token):
     lang = session.get('language', 'ru')
     t = get_translations(lang)
     
-    user = User.query.filter_by(reset_token=token).first()
+    user = get_user_by_reset_token(token)
     
-    if not user or not user.reset_token_expires or user.reset_token_expires < datetime.utcnow():
+    if not user:
         flash(t['reset_password_sent'], 'danger')
         return render_template('reset_confirm.html', token=None, valid=False, t=t, lang=lang)
     
@@ -782,10 +2512,13 @@ def reset_password_confirm(token):
         
         try:
             user.set_password(new_password)
-            user.reset_token = None
-            user.reset_token_expires = None
+            # Все ссылки пользователя становятся недействительными
+            PasswordResetToken.query.filter_by(user_id=user.id).delete()
             db.session.commit()
             
+            if app.config['SESSION_STORE'] == 'database':
+                revoke_user_sessions(user.id)
+            
             flash(t['password_updated'], 'success')
             return render_template('reset_confirm.html', token=None, valid=False, success=True, t=t, lang=lang)
             
@@ -803,6 +2536,8 @@ def logout():
     t = get_translations(lang)
     
     session.pop('user_id', None)
+    # Старый id сессии удаляется из БД и сразу перестает действовать во всех воркерах
+    regenerate_session()
     flash(t['logout_success'], 'success')
     return redirect(url_for('index'))
 
@@ -821,10 +2556,7 @@ def add_contragent():
     if copy_id_str:
         try:
             copy_id = int(copy_id_str)  # Преобразуем в int
-            contragent_to_copy = Contragent.query.filter_by(
-                id=copy_id, 
-                user_id=session['user_id']
-            ).first()
+            contragent_to_copy = get_contragent_for_user(copy_id, session['user_id'], readable_team_ids())
             
             if not contragent_to_copy:
                 flash(t['copy_not_found'], 'danger')
@@ -845,13 +2577,43 @@ def add_contragent():
                 flash(t['org_name_required'], 'danger')
                 return redirect(url_for('add_contragent'))
             
+            # Добавление сразу в общую книгу команды (нужна роль write или owner)
+            team_id = request.form.get('team_id', type=int)
+            if team_id is not None and team_id not in writable_team_ids():
+                flash(t['team_access_denied'], 'danger')
+                return redirect(url_for('add_contragent'))
+            
+            # Проверка дубликатов (в том числе при копировании) - подтверждается повторной отправкой формы
+            if request.form.get('allow_duplicate') != '1':
+                duplicates = find_duplicate_contragents(session['user_id'], readable_team_ids(), inn, org_name)
+                if duplicates:
+                    form_contragent = Contragent(
+                        org_name=org_name,
+                        inn=inn,
+                        contact_person=contact_person,
+                        position=position,
+                        address=address,
+                        phones=[Phone(number=p.strip()) for p in request.form.getlist('phones[]') if p and p.strip()],
+                        emails=[Email(address=e.strip()) for e in request.form.getlist('emails[]') if e and e.strip()],
+                        websites=[Website(url=w.strip()) for w in request.form.getlist('websites[]') if w and w.strip()]
+                    )
+                    return render_template('add.html',
+                                         contragent=form_contragent,
+                                         is_copy=False,
+                                         duplicates=duplicates,
+                                         teams=writable_teams(),
+                                         team_id=team_id,
+                                         t=t,
+                                         lang=lang)
+            
             contragent = Contragent(
                 org_name=org_name,
                 inn=inn if inn else None,
                 contact_person=contact_person if contact_person else None,
                 position=position if position else None,
                 address=address if address else None,
-                user_id=session['user_id']
+                user_id=session['user_id'],
+                team_id=team_id
             )
             
             db.session.add(contragent)
@@ -878,8 +2640,17 @@ def add_contragent():
                     website_obj = Website(contragent_id=contragent.id, url=website.strip())
                     db.session.add(website_obj)
             
+            contragent_id = contragent.id
             db.session.commit()
             
+            record_audit(session['user_id'], contragent_id, 'create', diff_snapshots({}, audit_snapshot(
+                {'org_name': org_name, 'inn': inn, 'contact_person': contact_person,
+                 'position': position, 'address': address},
+                [p.strip() for p in phones if p and p.strip()],
+                [e.strip() for e in emails if e and e.strip()],
+                [w.strip() for w in websites if w and w.strip()]
+            )))
+            
             flash(t['add_success'], 'success')
             return redirect(url_for('index'))
             
@@ -892,6 +2663,8 @@ def add_contragent():
     return render_template('add.html', 
                          contragent=contragent_to_copy, 
                          is_copy=bool(copy_id_str),
+                         teams=writable_teams(),
+                         team_id=request.args.get('team_id', type=int),
                          t=t,
                          lang=lang)
 
@@ -903,10 +2676,12 @@ def edit_contragent(id):
     lang = session.get('language', 'ru')
     t = get_translations(lang)
     
-    contragent = Contragent.query.filter_by(id=id, user_id=session['user_id']).first_or_404()
+    contragent = db.first_or_404(contragent_by_id_stmt(id, session['user_id'], writable_team_ids()))
     
     if request.method == 'POST':
         try:
+            old_snapshot = contragent_snapshot(contragent)
+            
             contragent.org_name = request.form.get('org_name', '').strip()
             contragent.inn = request.form.get('inn', '').strip() or None
             contragent.contact_person = request.form.get('contact_person', '').strip() or None
@@ -937,8 +2712,16 @@ def edit_contragent(id):
                     website_obj = Website(contragent_id=contragent.id, url=website.strip())
                     db.session.add(website_obj)
             
+            new_snapshot = audit_snapshot(
+                {field: getattr(contragent, field) for field in AUDIT_FIELDS},
+                [p.strip() for p in phones if p and p.strip()],
+                [e.strip() for e in emails if e and e.strip()],
+                [w.strip() for w in websites if w and w.strip()]
+            )
             db.session.commit()
             
+            record_audit(session['user_id'], id, 'update', diff_snapshots(old_snapshot, new_snapshot))
+            
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return jsonify({'success': True, 'message': t['edit_success']})
             else:
@@ -970,18 +2753,467 @@ def delete_contragent(id):
     t = get_translations(lang)
     
     try:
-        contragent = Contragent.query.filter_by(id=id, user_id=session['user_id']).first()
-        
+        contragent = get_contragent_for_user(id, session['user_id'], writable_team_ids())
         if not contragent:
             return jsonify({'success': False, 'message': 'Контрагент не найден'})
+        # Снимок до удаления: после окончательной очистки журнал - единственное,
+        # что остается от записи
+        old_snapshot = contragent_snapshot(contragent)
+        
+        # Мягкое удаление: одна строка UPDATE, телефоны/email/сайты удалит фоновая задача
+        deleted_at = datetime.utcnow()
+        result = db.session.execute(
+            update(Contragent)
+            .where(Contragent.id == id,
+                   contragent_access_condition(session['user_id'], writable_team_ids()),
+                   Contragent.deleted_at.is_(None))
+            .values(deleted_at=deleted_at)
+            .execution_options(synchronize_session=False)
+        )
+        
+        if result.rowcount == 0:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'Контрагент не найден'})
         
-        db.session.delete(contragent)
         db.session.commit()
-        return jsonify({'success': True, 'message': t['delete_success']})
+        
+        changes = diff_snapshots(old_snapshot, {})
+        changes['deleted_at'] = {'old': None, 'new': deleted_at.isoformat()}
+        record_audit(session['user_id'], id, 'delete', changes)
+        return jsonify({
+            'success': True,
+            'message': t['delete_success'],
+            'undo_url': url_for('restore_contragent', id=id)
+        })
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': f'Ошибка при удалении: {str(e)}'})
 
+# Восстановление удаленного контрагента (в течение срока хранения)
+@app.route('/restore/<int:id>', methods=['POST'])
+@login_required
+def restore_contragent(id):
+    lang = session.get('language', 'ru')
+    t = get_translations(lang)
+    
+    cutoff = datetime.utcnow() - timedelta(days=app.config['SOFT_DELETE_RETENTION_DAYS'])
+    try:
+        result = db.session.execute(
+            update(Contragent)
+            .where(Contragent.id == id,
+                   contragent_access_condition(session['user_id'], writable_team_ids()),
+                   Contragent.deleted_at >= cutoff)
+            .values(deleted_at=None)
+        )
+        
+        if result.rowcount == 0:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': t['restore_expired']})
+        
+        db.session.commit()
+        
+        record_audit(session['user_id'], id, 'restore', {'deleted_at': {'old': 'deleted', 'new': None}})
+        return jsonify({'success': True, 'message': t['restore_success']})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'Ошибка при восстановлении: {str(e)}'})
+
+# ========== ПРОВЕРКИ ЗДОРОВЬЯ ==========
+# /healthz - процесс жив и отвечает, без обращения к базе.
+# /readyz - можно ли направлять трафик: база отвечает в пределах таймаута,
+# схема актуальна; заодно отдает загрузку пулов и глубину очередей.
+
+READYZ_TIMEOUT_MS = int(os.environ.get('READYZ_TIMEOUT_MS', 2000))
+
+def pool_stats(engine):
+    pool = engine.pool
+    if not hasattr(pool, 'checkedout'):
+        # NullPool: соединения не переиспользуются, загружать нечего
+        return {'class': type(pool).__name__}
+    size = pool.size()
+    capacity = size + max(pool._max_overflow, 0)
+    return {
+        'class': type(pool).__name__,
+        'size': size,
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'saturation': round(pool.checkedout() / capacity, 2) if capacity else None,
+    }
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    if not database_initialized or background_tasks_pid != os.getpid():
+        start_database_setup()
+        if not database_initialized:
+            return jsonify({'status': 'initializing', 'checks': {'database': 'initializing'}}), 503
+    
+    checks = {}
+    ready = True
+    
+    try:
+        with db.engine.connect() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                             {'timeout': str(READYZ_TIMEOUT_MS)})
+            conn.execute(text("SELECT 1"))
+            schema_version = conn.execute(select(func.max(SchemaMigration.version))).scalar() or 0
+            queued_jobs = conn.execute(
+                select(func.count(Job.id)).where(Job.status == 'queued')
+            ).scalar()
+        checks['database'] = 'ok'
+    except Exception as e:
+        ready = False
+        schema_version = None
+        queued_jobs = None
+        checks['database'] = f'error: {e.__class__.__name__}'
+    
+    # Миграции применяются только на PostgreSQL
+    expected_version = SCHEMA_MIGRATIONS[-1][0] if db.engine.dialect.name == 'postgresql' else 0
+    if schema_version is not None and schema_version < expected_version:
+        ready = False
+        checks['schema'] = 'outdated'
+    
+    replicas = {}
+    now = time.monotonic()
+    for key in replica_keys:
+        replicas[key] = {
+            'in_use': replica_in_use[key],
+            'healthy': replica_down_until[key] <= now,
+            'pool': pool_stats(db.engines[key]),
+        }
+    
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'checks': checks,
+        'schema_version': schema_version,
+        'schema_expected': expected_version,
+        'pool': pool_stats(db.engine),
+        'replicas': replicas,
+        'queues': {
+            'audit_buffer': audit_buffer.qsize(),
+            'audit_buffer_max': audit_buffer.maxsize,
+            'audit_retry': len(audit_failed_batch),
+            'audit_dropped': audit_dropped,
+            'jobs_queued': queued_jobs,
+        },
+    }), 200 if ready else 503
+
+# ========== ФОНОВЫЕ ЗАДАНИЯ ==========
+
+def job_to_dict(job, with_result=False):
+    data = {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if with_result and job.status in ('done', 'cancelled') and job.result:
+        data['result'] = json.loads(job.result)
+    return data
+
+# Постановка задания в очередь
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def create_job():
+    data = request.get_json() or {}
+    kind = data.get('kind')
+    params = data.get('params') or {}
+    
+    if kind not in JOB_HANDLERS:
+        return jsonify({'success': False, 'message': 'Неизвестный тип задания'}), 400
+    if not isinstance(params, dict):
+        return jsonify({'success': False, 'message': 'Параметры задания должны быть объектом'}), 400
+    if kind == 'import':
+        rows = params.get('contragents') or []
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return jsonify({'success': False, 'message': 'contragents должен быть списком объектов'}), 400
+        if len(rows) > JOB_IMPORT_MAX_ROWS:
+            return jsonify({'success': False, 'message': f'Не более {JOB_IMPORT_MAX_ROWS} строк за один импорт'}), 400
+        if params.get('team_id') is not None and params['team_id'] not in writable_team_ids():
+            lang = session.get('language', 'ru')
+            return jsonify({'success': False, 'message': get_translations(lang)['team_access_denied']}), 403
+    
+    job = Job(user_id=session['user_id'], kind=kind, params=json.dumps(params, ensure_ascii=False))
+    db.session.add(job)
+    db.session.commit()
+    return jsonify({'success': True, 'job': job_to_dict(job)}), 202
+
+# Последние задания пользователя
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    jobs = Job.query.filter_by(user_id=session['user_id']).order_by(Job.id.desc()).limit(50).all()
+    return jsonify({'success': True, 'jobs': [job_to_dict(job) for job in jobs]})
+
+# Статус задания (для опроса со страницы)
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=session['user_id']).first()
+    if not job:
+        return jsonify({'success': False, 'message': 'Задание не найдено'}), 404
+    return jsonify({'success': True, 'job': job_to_dict(job, with_result=True)})
+
+# Выгрузка результата экспорта: порции читаются из базы по одной и сразу отдаются клиенту
+@app.route('/api/jobs/<int:job_id>/export', methods=['GET'])
+@login_required
+def job_export(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=session['user_id'], kind='export', status='done').first()
+    if not job:
+        return jsonify({'success': False, 'message': 'Задание не найдено'}), 404
+    count = json.loads(job.result)['count']
+    chunks = JobResultChunk.__table__
+    
+    def generate():
+        yield f'{{"count": {count}, "contragents": ['
+        seq = 0
+        while True:
+            with db.engine.connect() as conn:
+                data = conn.execute(select(chunks.c.data)
+                                    .where(chunks.c.job_id == job_id, chunks.c.seq == seq)).scalar()
+            if data is None:
+                break
+            # Каждая порция - JSON-массив: склеиваем содержимое без скобок
+            yield (',' if seq else '') + data[1:-1]
+            seq += 1
+        yield ']}'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    response.headers['Content-Disposition'] = f'attachment; filename=export-{job_id}.json'
+    return response
+
+# Отмена задания: из очереди снимается сразу, выполняющееся останавливается на ближайшей отметке прогресса
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=session['user_id']).first()
+    if not job:
+        return jsonify({'success': False, 'message': 'Задание не найдено'}), 404
+    
+    # Условные UPDATE: между чтением и записью задание мог забрать воркер
+    jobs = Job.__table__
+    cancelled = db.session.execute(
+        update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'queued')
+        .values(status='cancelled', finished_at=datetime.utcnow())
+    ).rowcount
+    if not cancelled:
+        db.session.execute(
+            update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running')
+            .values(cancel_requested=True)
+        )
+    db.session.commit()
+    db.session.refresh(job)
+    return jsonify({'success': True, 'job': job_to_dict(job)})
+
+# ========== КОМАНДЫ ==========
+
+# Список команд пользователя
+@app.route('/api/teams', methods=['GET'])
+@login_required
+def list_teams():
+    acl = get_acl()
+    teams = Team.query.filter(Team.id.in_(list(acl))).order_by(Team.name).all() if acl else []
+    return jsonify({
+        'success': True,
+        'teams': [{'id': team.id, 'name': team.name, 'role': acl[team.id]} for team in teams]
+    })
+
+# Создание команды (создатель становится владельцем)
+@app.route('/api/teams', methods=['POST'])
+@login_required
+def create_team():
+    lang = session.get('language', 'ru')
+    t = get_translations(lang)
+    
+    data = request.get_json() or {}
+    name = (data.get('name') or '').strip()
+    if not name:
+        return jsonify({'success': False, 'message': t['team_name_required']})
+    
+    try:
+        team = Team(name=name[:100])
+        db.session.add(team)
+        db.session.flush()
+        db.session.add(TeamMember(team_id=team.id, user_id=session['user_id'], role='owner'))
+        team_id = team.id
+        db.session.commit()
+        return jsonify({'success': True, 'message': t['team_created'], 'team_id': team_id})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'Ошибка при создании команды: {str(e)}'})
+
+# Добавление участника или смена его роли (только владелец)
+@app.route('/api/teams/<int:team_id>/members', methods=['POST'])
+@login_required
+def set_team_member(team_id):
+    lang = session.get('language', 'ru')
+    t = get_translations(lang)
+    
+    if get_acl().get(team_id) != 'owner':
+        return jsonify({'success': False, 'message': t['team_access_denied']})
+    
+    data = request.get_json() or {}
+    role = data.get('role', 'read')
+    if role not in TEAM_ROLES:
+        return jsonify({'success': False, 'message': t['team_invalid_role']})
+    
+    member_user = get_user_by_username((data.get('username') or '').strip())
+    if not member_user:
+        return jsonify({'success': False, 'message': t['user_not_found']})
+    
+    try:
+        member = db.session.get(TeamMember, (team_id, member_user.id))
+        if member:
+            member.role = role
+        else:
+            db.session.add(TeamMember(team_id=team_id, user_id=member_user.id, role=role))
+        db.session.commit()
+        return jsonify({'success': True, 'message': t['team_member_saved']})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'Ошибка при сохранении участника: {str(e)}'})
+
+# Исключение участника (владелец исключает любого, участник может выйти сам)
+@app.route('/api/teams/<int:team_id>/members/<int:user_id>', methods=['DELETE'])
+@login_required
+def remove_team_member(team_id, user_id):
+    lang = session.get('language', 'ru')
+    t = get_translations(lang)
+    
+    if get_acl().get(team_id) != 'owner' and user_id != session['user_id']:
+        return jsonify({'success': False, 'message': t['team_access_denied']})
+    
+    TeamMember.query.filter_by(team_id=team_id, user_id=user_id).delete()
+    db.session.commit()
+    return jsonify({'success': True, 'message': t['team_member_removed']})
+
+# Перенос контрагента из личной книги в книгу команды (team_id = null - обратно в личную).
+# Забрать запись из книги команды (в личную или в другую команду) может только
+# владелец этой команды или автор записи; в целевой команде нужна роль write.
+@app.route('/api/contragents/<int:id>/share', methods=['POST'])
+@login_required
+def share_contragent(id):
+    lang = session.get('language', 'ru')
+    t = get_translations(lang)
+    
+    data = request.get_json() or {}
+    team_id = data.get('team_id')
+    user_id = session['user_id']
+    acl = get_acl()
+    if team_id is not None and acl.get(team_id) not in TEAM_WRITE_ROLES:
+        return jsonify({'success': False, 'message': t['team_access_denied']})
+    
+    contragent = db.session.execute(
+        select(Contragent.team_id, Contragent.user_id)
+        .where(Contragent.id == id,
+               contragent_access_condition(user_id, writable_team_ids()),
+               Contragent.deleted_at.is_(None))
+    ).first()
+    if contragent is None:
+        return jsonify({'success': False, 'message': 'Контрагент не найден'})
+    
+    old_team_id = contragent.team_id
+    if old_team_id == team_id:
+        return jsonify({'success': True, 'message': t['team_shared']})
+    if old_team_id is not None and acl.get(old_team_id) != 'owner' and contragent.user_id != user_id:
+        return jsonify({'success': False, 'message': t['team_access_denied']})
+    
+    # Условие на прежний team_id - чтобы параллельный перенос не проскочил между проверкой и записью
+    result = db.session.execute(
+        update(Contragent)
+        .where(Contragent.id == id,
+               Contragent.team_id.is_(None) if old_team_id is None else Contragent.team_id == old_team_id,
+               Contragent.deleted_at.is_(None))
+        .values(team_id=team_id)
+    )
+    if result.rowcount == 0:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Контрагент не найден'})
+    
+    db.session.commit()
+    record_audit(user_id, id, 'share', {'team_id': {'old': old_team_id, 'new': team_id}})
+    return jsonify({'success': True, 'message': t['team_shared']})
+
+# Подсказки для строки поиска
+@app.route('/api/v1/suggest', methods=['GET'])
+@login_required
+@replica_read
+def suggest():
+    query = request.args.get('q', '').strip().lower()[:100]
+    field = request.args.get('field', 'org_name')
+    if field not in SUGGEST_FIELDS:
+        field = 'org_name'
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), SUGGEST_MAX_LIMIT)
+    except ValueError:
+        limit = 10
+    
+    suggestions = get_suggestions(session['user_id'], readable_team_ids(), field, query, limit) if query else []
+    
+    response = jsonify({'success': True, 'field': field, 'suggestions': suggestions})
+    response.headers['Cache-Control'] = f'private, max-age={SUGGEST_CACHE_TTL}'
+    return response
+
+# История изменений (постранично, от новых к старым)
+@app.route('/api/history', methods=['GET'])
+@login_required
+@replica_read
+def change_history():
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        before_id = int(request.args['before_id']) if request.args.get('before_id') else None
+        contragent_id = int(request.args['contragent_id']) if request.args.get('contragent_id') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Некорректные параметры'}), 400
+    
+    if contragent_id is not None:
+        # История конкретного контрагента видна всем, у кого есть к нему доступ
+        visible = db.session.execute(
+            select(Contragent.id).where(
+                Contragent.id == contragent_id,
+                contragent_access_condition(session['user_id'], readable_team_ids())
+            )
+        ).first()
+        if not visible:
+            return jsonify({'success': False, 'message': 'Контрагент не найден'}), 404
+        stmt = select(AuditLog).where(AuditLog.contragent_id == contragent_id)
+    else:
+        stmt = select(AuditLog).where(AuditLog.user_id == session['user_id'])
+    if before_id is not None:
+        stmt = stmt.where(AuditLog.id < before_id)
+    entries = db.session.execute(stmt.order_by(AuditLog.id.desc()).limit(limit)).scalars().all()
+    
+    return jsonify({
+        'success': True,
+        'history': [{
+            'id': entry.id,
+            'contragent_id': entry.contragent_id,
+            'action': entry.action,
+            'changes': json.loads(entry.changes),
+            'created_at': entry.created_at.isoformat()
+        } for entry in entries],
+        'next_before_id': entries[-1].id if len(entries) == limit else None
+    })
+
+# Отчет о дубликатах
+@app.route('/api/duplicates', methods=['GET'])
+@login_required
+def duplicates_report():
+    try:
+        threshold = min(max(float(request.args.get('threshold', 0.6)), 0.1), 1.0)
+    except ValueError:
+        threshold = 0.6
+    
+    report = build_duplicates_report(session['user_id'], threshold=threshold)
+    return jsonify({'success': True, **report})
+
 # ========== ЗАПУСК ПРИЛОЖЕНИЯ ==========
 
 if __name__ == '__main__':
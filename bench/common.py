@@ -0,0 +1,19 @@
+# ========== ОБЩЕЕ ДЛЯ БЕНЧМАРКОВ ==========
+# Корень репозитория в sys.path и база для замеров: DATABASE_URL из окружения,
+# а если он не задан - временная SQLite.
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def database_url():
+    return os.environ.get('DATABASE_URL') or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+
+
+def use_bench_database():
+    """Задает DATABASE_URL для приложения - вызывать до import app"""
+    os.environ['DATABASE_URL'] = database_url()
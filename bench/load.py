@@ -0,0 +1,134 @@
+# ========== НАГРУЗОЧНЫЙ ТЕСТ GUNICORN ==========
+# Запускает gunicorn с выбранным типом воркеров, заполняет книгу контрагентов
+# и в течение --duration секунд опрашивает страницу из --concurrency потоков.
+#
+#   python bench/load.py --worker-class sync
+#   python bench/load.py --worker-class gthread --concurrency 32
+#   python bench/load.py --worker-class gevent --path /api/v1/suggest?field=org_name&q=Орг
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from common import ROOT, database_url
+
+
+def wait_until_up(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"❌ gunicorn завершился с кодом {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/healthz", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    sys.exit("❌ gunicorn не поднялся вовремя")
+
+
+def login(base_url, username, password):
+    client = requests.Session()
+    client.post(f"{base_url}/api/register", json={
+        'username': username, 'email': f'{username}@bench.local',
+        'password': password, 'confirm_password': password,
+    })
+    response = client.post(f"{base_url}/api/login", json={'username': username, 'password': password})
+    if not response.json().get('success'):
+        sys.exit(f"❌ Не удалось войти: {response.text}")
+    return client
+
+
+def seed(client, base_url, count):
+    for i in range(count):
+        client.post(f"{base_url}/add", data={
+            'org_name': f'Организация {i}',
+            'inn': str(7700000000 + i),
+            'phones[]': [f'+7 900 {i:07d}'],
+            'emails[]': [f'info{i}@bench.local'],
+            'allow_duplicate': '1',
+        }, allow_redirects=False)
+
+
+def run_load(base_url, cookies, path, concurrency, duration):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker():
+        nonlocal errors
+        client = requests.Session()
+        client.cookies.update(cookies)
+        local = []
+        local_errors = 0
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                ok = client.get(f"{base_url}{path}", timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            local.append(time.perf_counter() - started)
+            local_errors += not ok
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест gunicorn')
+    parser.add_argument('--worker-class', default='gthread', choices=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--workers', type=int, help='WEB_CONCURRENCY (по умолчанию из gunicorn.conf.py)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--seed', type=int, default=200, help='Сколько контрагентов создать')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PORT=str(args.port), GUNICORN_WORKER_CLASS=args.worker_class,
+               GUNICORN_LOG_LEVEL='warning')
+    env['DATABASE_URL'] = database_url()
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    # Журнал доступа отключаем, чтобы вывод в консоль не ограничивал пропускную способность
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_up(base_url, process)
+        client = login(base_url, 'bench', 'bench-password')
+        seed(client, base_url, args.seed)
+        # Прогрев: шаблоны, соединения, кэши
+        run_load(base_url, client.cookies, args.path, args.concurrency, 2)
+        latencies, errors = run_load(base_url, client.cookies, args.path, args.concurrency, args.duration)
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies.sort()
+    print(f"📊 {args.worker_class}: {len(latencies)} запросов за {args.duration:.0f} с, "
+          f"{args.concurrency} потоков, ошибок: {errors}")
+    print(f"   RPS: {len(latencies) / args.duration:.1f}")
+    print(f"   p50: {statistics.median(latencies) * 1000:.1f} мс, "
+          f"p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} мс, "
+          f"max: {latencies[-1] * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# ========== НАКЛАДНЫЕ РАСХОДЫ ORM НА ГОРЯЧИХ ЗАПРОСАХ ==========
+# Сравнивает исходные запросы через Model.query (до) с горячими запросами
+# на lambda_stmt (после): поиск пользователя по id, логину, email и загрузку
+# книги контрагентов вместе с телефонами, email и сайтами.
+#
+#   python bench/orm_overhead.py --contragents 200 --repeat 500
+#
+# Для сравнения с prepare_threshold запускайте с DB_POOL_SIZE > 0 на PostgreSQL.
+import argparse
+import time
+
+from common import use_bench_database
+
+
+def measure(label, func, repeat, session):
+    func()  # прогрев кэшей компиляции
+    session.expunge_all()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+        # Каждый вызов - как новый HTTP-запрос: без объектов в identity map
+        session.expunge_all()
+    elapsed = time.perf_counter() - started
+    print(f"   {label:<34} {elapsed / repeat * 1e6:9.1f} мкс/вызов")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Накладные расходы ORM на горячих запросах')
+    parser.add_argument('--contragents', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    use_bench_database()
+    import app as application
+    from app import app, db, User, Contragent, Phone, Email, Website
+
+    with app.app_context():
+        application.setup_database()
+        user = User(username='bench', email='bench@bench.local')
+        user.set_password('bench-password')
+        db.session.add(user)
+        db.session.flush()
+        for i in range(args.contragents):
+            db.session.add(Contragent(
+                org_name=f'Организация {i}', inn=str(7700000000 + i), user_id=user.id,
+                phones=[Phone(number=f'+7 900 {i:07d}')],
+                emails=[Email(address=f'info{i}@bench.local')],
+                websites=[Website(url=f'https://org{i}.bench.local')]
+            ))
+        db.session.commit()
+        user_id, username, email = user.id, user.username, user.email
+        session = db.session
+
+        def touch_children(contragents):
+            # Шаблон index.html обращается ко всем дочерним коллекциям
+            for contragent in contragents:
+                len(contragent.phones), len(contragent.emails), len(contragent.websites)
+
+        cases = [
+            ('пользователь по id',
+             lambda: User.query.get(user_id),
+             lambda: application.get_user_by_id(user_id)),
+            ('пользователь по логину',
+             lambda: User.query.filter_by(username=username).first(),
+             lambda: application.get_user_by_username(username)),
+            ('пользователь по email',
+             lambda: User.query.filter_by(email=email).first(),
+             lambda: application.get_user_by_email(email)),
+            (f'книга из {args.contragents} контрагентов',
+             lambda: touch_children(Contragent.query.filter_by(user_id=user_id)
+                                    .order_by(Contragent.id.desc()).all()),
+             lambda: touch_children(application.get_contragents_for_user(user_id, []))),
+        ]
+
+        print(f"📊 {db.engine.dialect.name}, {args.repeat} повторов")
+        for name, before, after in cases:
+            print(f"🔹 {name}")
+            elapsed_before = measure('до (Model.query)', before, args.repeat, session)
+            elapsed_after = measure('после (lambda_stmt)', after, args.repeat, session)
+            print(f"   ускорение: x{elapsed_before / elapsed_after:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# ========== ВРЕМЯ ЗАПУСКА ==========
+# Измеряет время импорта приложения и первого запроса к каждому маршруту
+# в свежем процессе в трех режимах:
+#   cold    - пустой кэш байткода шаблонов (первый запуск после деплоя)
+#   warm    - кэш байткода уже на диске (перезапуск воркера)
+#   preload - шаблоны скомпилированы до первого запроса, как при GUNICORN_PRELOAD
+#
+#   python bench/startup.py --runs 5
+#
+# Каждый замер - отдельный интерпретатор, база - временная SQLite.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT
+
+ROUTES = [
+    '/',
+    '/add',
+    '/edit/1',
+    '/reset-password/unknown-token',
+    '/api/v1/suggest?field=org_name&q=Ром',
+    '/api/history',
+    '/api/duplicates',
+    '/api/teams',
+    '/api/jobs',
+    '/healthz',
+    '/readyz',
+]
+
+
+def child(preload):
+    """Один замер в свежем процессе; результат - JSON в stdout"""
+    timings = {}
+    started = time.perf_counter()
+    import app as application
+    timings['import'] = time.perf_counter() - started
+
+    if preload:
+        started = time.perf_counter()
+        application.compile_templates()
+        timings['compile_templates'] = time.perf_counter() - started
+
+    client = application.app.test_client()
+    # Создание таблиц не относится к шаблонам - выполняем и меряем отдельно
+    started = time.perf_counter()
+    with application.app.app_context():
+        application.setup_database()
+    timings['setup_database'] = time.perf_counter() - started
+
+    client.post('/api/login', json={'username': 'admin', 'password': 'admin123'})
+    client.post('/add', data={'org_name': 'Ромашка', 'allow_duplicate': '1'})
+    for route in ROUTES:
+        started = time.perf_counter()
+        response = client.get(route)
+        timings[route] = time.perf_counter() - started
+        if response.status_code >= 500:
+            timings[route] = None
+    print(json.dumps(timings))
+
+
+def run(mode, cache_dir, runs):
+    results = []
+    for _ in range(runs):
+        workdir = tempfile.mkdtemp()
+        if mode == 'cold':
+            cache_dir = os.path.join(workdir, 'jinja_cache')
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{workdir}/startup.db", JINJA_CACHE_DIR=cache_dir)
+        args = [sys.executable, os.path.abspath(__file__), '--child']
+        if mode == 'preload':
+            args.append('--preload')
+        output = subprocess.run(args, env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время импорта и первого запроса к маршрутам')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.preload)
+        return
+
+    # Для warm и preload кэш байткода заполняется заранее одним прогоном
+    warm_cache = os.path.join(tempfile.mkdtemp(), 'jinja_cache')
+    run('warm', warm_cache, 1)
+
+    modes = {mode: run(mode, warm_cache, args.runs) for mode in ('cold', 'warm', 'preload')}
+
+    def median_ms(results, key):
+        values = [result.get(key) for result in results]
+        if any(value is None for value in values):
+            return '   ошибка'
+        return f"{statistics.median(values) * 1000:9.1f}"
+
+    keys = ['import', 'compile_templates', 'setup_database'] + ROUTES
+    print(f"📊 медиана по {args.runs} запускам, мс")
+    print(f"   {'':<40} {'cold':>9} {'warm':>9} {'preload':>9}")
+    for key in keys:
+        row = []
+        for mode in ('cold', 'warm', 'preload'):
+            row.append(median_ms(modes[mode], key) if key in modes[mode][0] else '        -')
+        print(f"   {key:<40} {row[0]} {row[1]} {row[2]}")
+
+
+if __name__ == '__main__':
+    main()
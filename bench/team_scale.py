@@ -0,0 +1,155 @@
+# ========== МАСШТАБНЫЙ ТЕСТ ОБЩИХ КНИГ КОМАНД ==========
+# Команда из --members участников делит книгу из --contragents контрагентов
+# (у каждого по телефону и email), у каждого участника есть и небольшая личная книга.
+# Через тестовый клиент измеряются главная страница, глубокая страница, поиск
+# по полям и проверка дубликатов от лица разных участников.
+#
+#   python bench/team_scale.py                       # 100 участников, 500 000 контрагентов
+#   python bench/team_scale.py --contragents 50000 --repeat 20
+#
+# Заполнение идет пакетными INSERT, на PostgreSQL после него выполняется ANALYZE.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from common import use_bench_database
+
+PASSWORD = 'bench-password'
+
+
+def seed(members, contragents, personal, batch_size=10000):
+    from app import db, User, Team, TeamMember, Contragent, Phone, Email
+    from sqlalchemy import insert, select, text
+    from werkzeug.security import generate_password_hash
+
+    password_hash = generate_password_hash(PASSWORD)
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {'username': f'member{i}', 'email': f'member{i}@bench.local', 'password_hash': password_hash,
+             'created_at': now} for i in range(members)
+        ])
+        user_ids = conn.execute(select(User.id).where(User.username.like('member%')).order_by(User.id)).scalars().all()
+        team_id = conn.execute(insert(Team.__table__).values(name='Bench team', created_at=now)
+                               .returning(Team.id)).scalar()
+        conn.execute(insert(TeamMember.__table__), [
+            {'team_id': team_id, 'user_id': user_id, 'role': 'owner' if i == 0 else 'write'}
+            for i, user_id in enumerate(user_ids)
+        ])
+
+    started = time.perf_counter()
+    rows = [(team_id, user_ids[i % len(user_ids)], i) for i in range(contragents)]
+    rows += [(None, user_id, contragents + j * len(user_ids) + k)
+             for j in range(personal) for k, user_id in enumerate(user_ids)]
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        with db.engine.begin() as conn:
+            first_id = conn.execute(select(db.func.coalesce(db.func.max(Contragent.id), 0))).scalar() + 1
+            conn.execute(insert(Contragent.__table__), [{
+                'id': first_id + n,
+                'org_name': f'Организация {number}',
+                'inn': str(7700000000 + number),
+                'inn_normalized': str(7700000000 + number),
+                'org_name_normalized': f'организация {number}',
+                'contact_person': f'Контакт {number % 9973}',
+                'user_id': user_id,
+                'team_id': row_team_id,
+                'created_at': now,
+            } for n, (row_team_id, user_id, number) in enumerate(batch)])
+            conn.execute(insert(Phone.__table__), [{
+                'contragent_id': first_id + n,
+                'number': f'+7 900 {number:07d}',
+                'number_normalized': f'7900{number:07d}',
+            } for n, (_, _, number) in enumerate(batch)])
+            conn.execute(insert(Email.__table__), [{
+                'contragent_id': first_id + n,
+                'address': f'info{number}@bench.local',
+                'address_normalized': f'info{number}@bench.local',
+            } for n, (_, _, number) in enumerate(batch)])
+        print(f"\r   заполнено {min(start + batch_size, len(rows))}/{len(rows)}", end='', flush=True)
+    print(f"\n✅ Заполнение: {time.perf_counter() - started:.1f} с")
+
+    with db.engine.begin() as conn:
+        conn.execute(text('ANALYZE'))
+    return user_ids, team_id
+
+
+def measure(client, url, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            sys.exit(f"❌ {url}: HTTP {response.status_code}")
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Масштабный тест общих книг команд')
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--contragents', type=int, default=500000)
+    parser.add_argument('--personal', type=int, default=10, help='Личных контрагентов у каждого участника')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--sample-members', type=int, default=5, help='От лица скольких участников мерить')
+    args = parser.parse_args()
+
+    use_bench_database()
+    # Сессии и журнал не должны влиять на замеры чтения
+    os.environ.setdefault('AUDIT_FLUSH_INTERVAL', '3600')
+    import app as application
+    from app import app, db
+
+    with app.app_context():
+        application.setup_database()
+        print(f"📦 {db.engine.dialect.name}: {args.members} участников, {args.contragents} общих контрагентов")
+        user_ids, team_id = seed(args.members, args.contragents, args.personal)
+
+    middle_id = args.contragents // 2
+    number = random.Random(1).randrange(args.contragents)
+    cases = [
+        ('первая страница', '/'),
+        ('глубокая страница', f'/?before={middle_id}'),
+        ('поиск: название, подстрока', f'/?field=org_name&q=изация {number}'),
+        ('поиск: ИНН', f'/?field=inn&q={7700000000 + number}'),
+        ('поиск: телефон, префикс', f'/?field=phones&q=8 900 {number:07d}'[:-2]),
+        ('поиск: email, префикс', f'/?field=emails&q=info{number}@'),
+        ('поиск: все поля', f'/?field=all&q=Контакт {number % 9973}'),
+        ('поиск: все поля, нет совпадений', '/?field=all&q=zzzz-нет-такого'),
+        ('подсказки', f'/api/v1/suggest?field=org_name&q=Организация {number // 10}'),
+    ]
+
+    results = {name: [] for name, _ in cases}
+    duplicate_timings = []
+    for user_id in random.Random(2).sample(user_ids, min(args.sample_members, len(user_ids))):
+        client = app.test_client()
+        client.post('/api/login', json={'username': f'member{user_ids.index(user_id)}', 'password': PASSWORD})
+        for name, url in cases:
+            results[name].append(measure(client, url, args.repeat))
+        with app.test_request_context():
+            with app.app_context():
+                team_ids = [team_id]
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    application.find_duplicate_contragents(user_id, team_ids, str(7700000000 + number),
+                                                           f'Организация {number}')
+                    duplicate_timings.append(time.perf_counter() - started)
+                db.session.remove()
+
+    print(f"📊 медиана / p95 по {args.sample_members} участникам, {args.repeat} повторов")
+    for name, _ in cases:
+        medians = [m for m, _ in results[name]]
+        p95s = [p for _, p in results[name]]
+        print(f"   {name:<34} {statistics.median(medians) * 1000:8.1f} мс  {max(p95s) * 1000:8.1f} мс")
+    duplicate_timings.sort()
+    print(f"   {'проверка дубликатов':<34} {statistics.median(duplicate_timings) * 1000:8.1f} мс  "
+          f"{duplicate_timings[int(len(duplicate_timings) * 0.95)] * 1000:8.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
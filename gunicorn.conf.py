@@ -0,0 +1,111 @@
+# ========== КОНФИГУРАЦИЯ GUNICORN ==========
+# Все параметры можно переопределить переменными окружения (например, на Render).
+#
+#   GUNICORN_WORKER_CLASS   sync | gthread | gevent (по умолчанию gthread)
+#   WEB_CONCURRENCY         число процессов (по умолчанию 2 * CPU + 1, но не больше,
+#                           чем позволяет DB_MAX_CONNECTIONS)
+#   DB_MAX_CONNECTIONS      сколько соединений с PostgreSQL может открыть веб-сервис
+#                           (по умолчанию 40 - с запасом под лимит тарифа и воркер заданий)
+#   GUNICORN_THREADS        потоков на процесс для gthread (по умолчанию 4)
+#   GUNICORN_WORKER_CONNECTIONS  одновременных соединений на процесс для gevent
+#   GUNICORN_TIMEOUT        таймаут воркера в секундах
+#   GUNICORN_KEEPALIVE      keep-alive в секундах
+#   GUNICORN_PRELOAD        загружать приложение в мастере до fork (по умолчанию true)
+import os
+import sys
+
+# Конфиг читается до --chdir - общие модули ищем рядом с ним
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from system_limits import available_cpus
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread').lower()
+
+if worker_class == 'gevent':
+    # Патчим стандартную библиотеку ДО импорта приложения, чтобы psycopg
+    # выбрал кооперативную функцию ожидания, а requests не блокировал воркер
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+cpu_count = available_cpus()
+
+if worker_class == 'gthread':
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+elif worker_class == 'gevent':
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+# Сколько соединений с основной базой может держать один процесс.
+# С пулом (DB_POOL_SIZE > 0) - его размер: пул ограничивает все потоки процесса.
+# Без пула (NullPool) соединения ничем не ограничены, поэтому считаем худший случай:
+#   - запрос держит до двух: db.session и запись серверной сессии (save_session);
+#   - фоновые потоки (app.start_background_tasks): сброс журнала и три общие
+#     чистки, каждая со своим соединением;
+# и еще одно на все развертывание - соединение лидера чисток с advisory-блокировкой.
+# Для gevent оценка - число одновременных запросов, поэтому с gevent стоит включать DB_POOL_SIZE.
+CONNECTIONS_PER_REQUEST = 2
+BACKGROUND_CONNECTIONS = 4
+SWEEPER_CONNECTIONS = 1
+
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', 0))
+if worker_class == 'gthread':
+    concurrent_requests = threads
+elif worker_class == 'gevent':
+    concurrent_requests = worker_connections
+else:
+    concurrent_requests = 1
+if db_pool_size > 0:
+    connections_per_worker = db_pool_size + int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    reserved_connections = 0
+else:
+    connections_per_worker = concurrent_requests * CONNECTIONS_PER_REQUEST + BACKGROUND_CONNECTIONS
+    reserved_connections = SWEEPER_CONNECTIONS
+
+if 'WEB_CONCURRENCY' in os.environ:
+    workers = int(os.environ['WEB_CONCURRENCY'])
+else:
+    db_max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 40))
+    workers = max(1, min(cpu_count * 2 + 1, (db_max_connections - reserved_connections) // connections_per_worker))
+
+# Письмо через Unisender ждет ответа до 30 секунд - таймаут воркера должен быть больше
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Периодически перезапускаем воркеры, чтобы не копилась память
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+# Приложение импортируется один раз в мастере: воркеры стартуют быстрее
+# и получают уже скомпилированные шаблоны через fork
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import app as application
+    try:
+        # Таблицы и миграции - один раз до запуска воркеров, а не в каждом из них
+        application.setup_database()
+    except Exception as e:
+        server.log.warning(f"Инициализация БД отложена до первого запроса: {e}")
+    names = application.compile_templates()
+    server.log.info(f"Шаблоны скомпилированы заранее: {len(names)}")
+    # Соединения мастера не должны достаться воркерам
+    with application.app.app_context():
+        for engine in application.db.engines.values():
+            engine.dispose()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    import app as application
+    with application.app.app_context():
+        for engine in application.db.engines.values():
+            engine.dispose(close=False)
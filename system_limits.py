@@ -0,0 +1,26 @@
+# ========== РЕСУРСЫ КОНТЕЙНЕРА ==========
+# Общие для gunicorn.conf.py и app.py оценки ресурсов. Модуль ничего не
+# импортирует из приложения, поэтому его можно загружать в мастере gunicorn
+# без preload_app.
+import math
+import multiprocessing
+import os
+
+
+def available_cpus():
+    """
+    Сколько CPU реально доступно процессу. cpu_count() в контейнере
+    возвращает число CPU хоста, поэтому учитываем affinity и квоту cgroup v2.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus